@@ -1,7 +1,20 @@
 
 
 from .polylogger import LOG_HANDLER,LOGGER
-from .polyinterface import Interface, Node, Controller, unload_interface, get_network_interface
+from .polyinterface import Interface, Node, Controller, unload_interface, get_network_interface, coalesce
+from .recorder import Recorder, Replayer
+try:
+    # async generators, Python 3.6 and later
+    from .discovery import Discovery
+except SyntaxError:
+    Discovery = None
+from .history import DriverHistory
+from .tracing import Tracer
+from .registry import NodeRegistry, PendingNodes
+from .host import ProfileHost
+from .netinfo import NetworkInfo, NETWORK_INFO
+from .pool import ConnectionPool, PoolTimeout
+from .transport import MqttTransport, MemoryBroker, MemoryTransport, MqttBroker, UnixSocketBroker, UnixSocketTransport
 
 __version__ = '2.1.0'
 __description__ = 'UDI Polyglot v2 Interface'
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Concurrent device discovery on the local subnet.
+
+Discovery sweeps the hosts of the subnet from get_network_interface (or a
+given list of hosts) with asyncio, probing TCP ports and sending UDP
+requests such as SSDP M-SEARCH, with bounded concurrency and per probe
+timeouts. Results are yielded as they arrive and cached for ttl seconds so
+a repeated sweep does not probe the same host and port again.
+
+From a coroutine:
+
+    async for found in discovery.sweep(ports=[80, 8080]):
+        ...
+
+From a plain NodeServer thread:
+
+    found = Discovery(ports=[80]).discover()
+
+Needs Python 3.6 or later, polyinterface.Discovery is None on older versions.
+"""
+
+import asyncio
+import ipaddress
+import socket
+import time
+from .polylogger import LOGGER
+from .netinfo import NETWORK_INFO
+
+SSDP_ADDRESS = ('239.255.255.250', 1900)
+
+
+class Discovery(object):
+    """
+    :param ports: TCP ports to probe on every host
+    :param timeout: Seconds to wait for each probe
+    :param concurrency: Maximum number of probes in flight
+    :param ttl: Seconds results, including no answer, are cached
+    :param maxHosts: Largest number of hosts swept from the local subnet
+    """
+    def __init__(self, ports=(80,), timeout=1.0, concurrency=64, ttl=300, maxHosts=1024):
+        self.ports = list(ports)
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.maxHosts = maxHosts
+        self._cache = {}
+
+    def subnetHosts(self, interface='default'):
+        """ Host addresses of the subnet of interface, without our own address """
+        info = NETWORK_INFO.get(interface)
+        if not info.get('addr') or not info.get('netmask'):
+            LOGGER.error('Discovery: no address for interface {}'.format(interface))
+            return []
+        network = ipaddress.ip_network(u'{}/{}'.format(info['addr'], info['netmask']), strict=False)
+        hosts = []
+        for host in network.hosts():
+            host = str(host)
+            if host == info['addr']:
+                continue
+            if len(hosts) >= self.maxHosts:
+                LOGGER.warning('Discovery: {} is larger than maxHosts, only sweeping {}'.format(network, self.maxHosts))
+                break
+            hosts.append(host)
+        return hosts
+
+    def _cached(self, key):
+        entry = self._cache.get(key)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            return entry
+        return None
+
+    def clearCache(self):
+        self._cache = {}
+
+    async def probeTcp(self, host, port):
+        """ Result dict if host accepts a connection on port within timeout, else None """
+        start = time.time()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        except (asyncio.TimeoutError, OSError):
+            return None
+        writer.close()
+        return {'host': host, 'port': port, 'proto': 'tcp', 'latency': time.time() - start}
+
+    async def sweep(self, hosts=None, ports=None):
+        """
+        Probe every host and port, yielding result dicts as they arrive.
+        Cached results are yielded first without probing.
+        """
+        if hosts is None:
+            hosts = self.subnetHosts()
+        ports = self.ports if ports is None else list(ports)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def probe(host, port):
+            async with semaphore:
+                result = await self.probeTcp(host, port)
+            self._cache[('tcp', host, port)] = (time.time(), result)
+            return result
+
+        tasks = []
+        for host in hosts:
+            for port in ports:
+                cached = self._cached(('tcp', host, port))
+                if cached is not None:
+                    if cached[1] is not None:
+                        yield cached[1]
+                    continue
+                tasks.append(probe(host, port))
+        LOGGER.debug('Discovery: probing {} host ports'.format(len(tasks)))
+        for future in asyncio.as_completed(tasks):
+            result = await future
+            if result is not None:
+                yield result
+
+    async def udp(self, payload, address, timeout=None, broadcast=False):
+        """
+        Send payload to address over UDP and yield (data, (host, port)) for
+        every reply received within timeout. Used for SSDP and broadcast probes.
+        """
+        loop = asyncio.get_event_loop()
+        replies = asyncio.Queue()
+
+        class Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                replies.put_nowait((data, addr))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if broadcast:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        sock.bind(('', 0))
+        transport, _ = await loop.create_datagram_endpoint(Protocol, sock=sock)
+        try:
+            transport.sendto(payload, address)
+            deadline = loop.time() + (self.timeout if timeout is None else timeout)
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    yield await asyncio.wait_for(replies.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            transport.close()
+
+    async def ssdp(self, searchTarget='ssdp:all', mx=2, address=SSDP_ADDRESS, timeout=None):
+        """
+        Send an SSDP M-SEARCH and yield a dict of the response headers for
+        every device that answers, with host set to the responder address.
+        Repeated answers from the same responder and location are yielded once.
+        """
+        request = '\r\n'.join([
+            'M-SEARCH * HTTP/1.1',
+            'HOST: {}:{}'.format(*address),
+            'MAN: "ssdp:discover"',
+            'MX: {}'.format(mx),
+            'ST: {}'.format(searchTarget),
+            '', '']).encode('ascii')
+        seen = set()
+        async for data, addr in self.udp(request, address, timeout=mx + 1 if timeout is None else timeout):
+            headers = {'host': addr[0], 'proto': 'ssdp'}
+            for line in data.decode('utf-8', 'replace').split('\r\n')[1:]:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+            key = ('ssdp', addr[0], headers.get('location'))
+            if key in seen:
+                continue
+            seen.add(key)
+            self._cache[key] = (time.time(), headers)
+            yield headers
+
+    def cached(self):
+        """ Results still within ttl from earlier sweeps and SSDP searches """
+        now = time.time()
+        return [result for stamp, result in self._cache.values() if result is not None and now - stamp < self.ttl]
+
+    def discover(self, hosts=None, ports=None):
+        """ Run sweep on a new event loop and return the list of results """
+        async def collect():
+            return [result async for result in self.sweep(hosts, ports)]
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(collect())
+        finally:
+            loop.close()
+
+    def discoverSsdp(self, searchTarget='ssdp:all', mx=2, address=SSDP_ADDRESS):
+        """ Run ssdp on a new event loop and return the list of responses """
+        async def collect():
+            return [result async for result in self.ssdp(searchTarget, mx, address)]
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(collect())
+        finally:
+            loop.close()
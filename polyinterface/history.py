@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Bounded value history for node drivers.
+
+List the drivers to keep history for, and how many samples of each, in the
+driverHistorySizes class attribute of a Node. setDriver then records every
+numeric value with its timestamp:
+
+    class Thermostat(polyinterface.Node):
+        driverHistorySizes = {'CLITEMP': 360}
+
+        def shortPoll(self):
+            temps = self.driverHistory('CLITEMP')
+            self.setDriver('GV1', temps.mean(3600))
+            self.setDriver('GV2', temps.rate(600) * 3600)
+
+Each DriverHistory is a ring buffer of two preallocated arrays of doubles,
+16 bytes per sample, so memory only depends on the sizes configured and
+not on how long the NodeServer runs.
+"""
+
+import time
+from array import array
+
+
+class DriverHistory(object):
+    """
+    Fixed size ring buffer of (timestamp, value) samples.
+
+    :param size: Number of samples kept, older samples are overwritten
+    """
+    __slots__ = ('size', '_times', '_values', '_next', '_count')
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('DriverHistory size must be at least 1')
+        self.size = size
+        self._times = array('d', [0.0]) * size
+        self._values = array('d', [0.0]) * size
+        self._next = 0
+        self._count = 0
+
+    def append(self, value, timestamp=None):
+        self._times[self._next] = time.time() if timestamp is None else timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _physical(self, i):
+        """ Array index of the i-th oldest sample """
+        return (self._next - self._count + i) % self.size
+
+    def _first(self, since):
+        """ Logical index of the oldest sample taken at or after since """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[self._physical(mid)] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _start(self, window, now):
+        """ Logical index of the oldest sample in the last window seconds, 0 for all """
+        if window is None:
+            return 0
+        return self._first((time.time() if now is None else now) - window)
+
+    def _slices(self, data, start):
+        """ One or two slices of data holding the samples from logical index start on """
+        count = self._count - start
+        if count <= 0:
+            return []
+        begin = self._physical(start)
+        end = begin + count
+        if end <= self.size:
+            return [data[begin:end]]
+        return [data[begin:], data[:end - self.size]]
+
+    def samples(self, window=None, now=None):
+        """ List of (timestamp, value) from oldest to newest, all or the last window seconds """
+        start = self._start(window, now)
+        times = [t for part in self._slices(self._times, start) for t in part]
+        values = [v for part in self._slices(self._values, start) for v in part]
+        return list(zip(times, values))
+
+    def values(self, window=None, now=None):
+        return [v for part in self._slices(self._values, self._start(window, now)) for v in part]
+
+    def last(self):
+        """ (timestamp, value) of the newest sample, None when empty """
+        if not self._count:
+            return None
+        i = (self._next - 1) % self.size
+        return (self._times[i], self._values[i])
+
+    def count(self, window=None, now=None):
+        return self._count - self._start(window, now)
+
+    def mean(self, window=None, now=None):
+        """ Average of the samples in the window, None when there are none """
+        parts = self._slices(self._values, self._start(window, now))
+        count = sum(len(part) for part in parts)
+        if not count:
+            return None
+        return sum(sum(part) for part in parts) / count
+
+    def min(self, window=None, now=None):
+        parts = self._slices(self._values, self._start(window, now))
+        if not parts:
+            return None
+        return min(min(part) for part in parts)
+
+    def max(self, window=None, now=None):
+        parts = self._slices(self._values, self._start(window, now))
+        if not parts:
+            return None
+        return max(max(part) for part in parts)
+
+    def rate(self, window=None, now=None):
+        """
+        Change per second between the oldest and newest sample in the window,
+        None when there are fewer than two samples or no time passed.
+        """
+        start = self._start(window, now)
+        if self._count - start < 2:
+            return None
+        first = self._physical(start)
+        newest = (self._next - 1) % self.size
+        elapsed = self._times[newest] - self._times[first]
+        if elapsed <= 0:
+            return None
+        return (self._values[newest] - self._values[first]) / elapsed
+
+    def __repr__(self):
+        return 'DriverHistory(size={}, count={})'.format(self.size, self._count)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Run several NodeServer profiles in one process over one MQTT connection.
+
+Each profile gets its own Interface, with its own input and event queues and
+threads, and its own Controller. The ProfileHost owns the connection and
+routes udi/polyglot/ns/<profileNum> messages to the Interface of that
+profile, so only one paho client, TLS session and network thread are needed:
+
+    host = polyinterface.ProfileHost()
+    HueController(host.addProfile(3))
+    SonosController(host.addProfile(4))
+    host.start()
+    host.runForever()
+
+The profiles share the working directory, set CUSTOM_CONFIG_DOCS_FILE_NAME
+on an Interface to give it its own configuration docs. POLY_RECORD and
+POLY_TRACE files get the profile number added, see Interface.profileFile.
+"""
+
+import os
+import ssl
+import time
+from threading import Lock, Thread
+from .polylogger import LOGGER
+from .polyinterface import Interface
+from .transport import MqttTransport, UnixSocketTransport
+
+
+class ProfileHost(object):
+    """
+    :param transport: Optional shared transport from polyinterface.transport, defaults to MQTT
+        or to a UnixSocketTransport when POLY_UNIX_SOCKET is set
+    """
+    def __init__(self, transport=None):
+        if transport is None:
+            if os.environ.get('POLY_UNIX_SOCKET'):
+                transport = UnixSocketTransport(os.environ['POLY_UNIX_SOCKET'])
+            else:
+                transport = MqttTransport(None, True, useSecure=os.environ.get('USE_HTTPS', True) is True)
+        self.transport = transport
+        self.profiles = {}
+        self.connected = False
+        self._server = os.environ.get("MQTT_HOST") or 'localhost'
+        self._port = os.environ.get("MQTT_PORT") or '1883'
+        self._lock = Lock()
+        self._stopped = set()
+        self._thread = Thread(target=self._startMqtt, name='Interface')
+        transport.on_connect = self._connect
+        transport.on_message = self._message
+        transport.on_disconnect = self._disconnect
+        transport.on_subscribe = None
+        transport.on_publish = None
+        transport.on_log = None
+
+    def addProfile(self, profileNum):
+        """ Create and return the Interface for profileNum, pass it to the profile's Controller """
+        profileNum = str(profileNum)
+        if profileNum in self.profiles:
+            raise ValueError('Profile {} is already hosted'.format(profileNum))
+        poly = Interface(profileNum=profileNum, host=self)
+        self.profiles[profileNum] = poly
+        LOGGER.info('Hosting profile {}'.format(profileNum))
+        return poly
+
+    def start(self):
+        """ Start the threads of every profile and connect """
+        for poly in self.profiles.values():
+            poly.start()
+        self._thread.start()
+
+    def runForever(self):
+        self._thread.join()
+
+    def _startMqtt(self):
+        LOGGER.info('Connecting to MQTT for profiles {}... {}:{}'.format(
+            ', '.join(sorted(self.profiles)), self._server, self._port))
+        while True:
+            try:
+                self.transport.connect_async('{}'.format(self._server), int(self._port), 10)
+                self.transport.loop_forever()
+                break
+            except ssl.SSLError as e:
+                LOGGER.error("MQTT Connection SSLError: {}, Will retry in a few seconds.".format(e), exc_info=True)
+                time.sleep(3)
+            except Exception as ex:
+                LOGGER.error("MQTT Connection error: {!r}".format(ex), exc_info=True)
+                break
+        LOGGER.debug("MQTT Done:")
+
+    def _connect(self, mqttc, userdata, flags, rc):
+        self.connected = rc == 0
+        for poly in list(self.profiles.values()):
+            poly._connect(mqttc, userdata, flags, rc)
+
+    def _message(self, mqttc, userdata, msg):
+        """ Route udi/polyglot/ns/<profileNum> to that profile, connection messages to all """
+        topic = msg.topic
+        if topic.startswith('udi/polyglot/ns/'):
+            poly = self.profiles.get(topic[len('udi/polyglot/ns/'):])
+            if poly is not None:
+                poly._message(mqttc, userdata, msg)
+            return
+        for poly in list(self.profiles.values()):
+            poly._message(mqttc, userdata, msg)
+
+    def _disconnect(self, mqttc, userdata, rc):
+        self.connected = False
+        for poly in self.profiles.values():
+            poly.connected = False
+        if rc != 0 and len(self._stopped) < len(self.profiles):
+            LOGGER.info("MQTT Unexpected disconnection. Trying reconnect.")
+            try:
+                self.transport.reconnect()
+            except Exception as ex:
+                LOGGER.error("MQTT Connection error: {!r}".format(ex))
+        else:
+            LOGGER.info("MQTT Graceful disconnection.")
+
+    def _release(self, poly):
+        """ Called by Interface.stop, disconnects once every profile has stopped """
+        with self._lock:
+            self._stopped.add(poly.profileNum)
+            last = len(self._stopped) == len(self.profiles)
+        if last and self.connected:
+            LOGGER.info('All hosted profiles stopped, disconnecting.')
+            self.transport.loop_stop()
+            self.transport.disconnect()
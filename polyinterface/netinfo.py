@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Cached network interface information with change notification.
+
+NETWORK_INFO is shared by the whole process. Lookups are served from a
+cache refreshed at most every ttl seconds, so NodeServers can ask for the
+local address as often as they like. Callbacks added with subscribe are
+called with (old, new) whenever an address or the default route changes,
+checked every interval seconds by a background thread.
+
+    polyinterface.NETWORK_INFO.get()                    # default IPv4 interface
+    polyinterface.NETWORK_INFO.get('eth0', netifaces.AF_INET6)
+    polyinterface.NETWORK_INFO.subscribe(lambda old, new: rediscover())
+"""
+
+import time
+from copy import deepcopy
+from threading import Event, Lock, Thread
+import netifaces
+from .polylogger import LOGGER
+
+AF_INET = netifaces.AF_INET
+AF_INET6 = netifaces.AF_INET6
+
+
+class NetworkInfo(object):
+    """
+    :param ttl: Seconds a cached lookup stays valid
+    :param interval: Seconds between change checks once someone subscribed
+    """
+    def __init__(self, ttl=30, interval=60):
+        self.ttl = ttl
+        self.interval = interval
+        self._state = None
+        self._readAt = 0
+        self._lock = Lock()
+        self._subscribers = []
+        self._watcher = None
+        self._stopped = Event()
+
+    @staticmethod
+    def _read():
+        gateways = netifaces.gateways()
+        state = {'default': {}, 'interfaces': {}}
+        for family in (AF_INET, AF_INET6):
+            gw = gateways.get('default', {}).get(family)
+            if gw:
+                state['default'][family] = (gw[0], gw[1])
+        for name in netifaces.interfaces():
+            addresses = netifaces.ifaddresses(name)
+            state['interfaces'][name] = dict((family, addresses.get(family, [])) for family in (AF_INET, AF_INET6))
+        return state
+
+    def refresh(self, force=False):
+        """
+        Re-read the interfaces if the cache is older than ttl, or always when
+        force is True. Returns True when something changed.
+        """
+        with self._lock:
+            if not force and self._state is not None and time.time() - self._readAt < self.ttl:
+                return False
+            old = self._state
+            new = self._read()
+            self._state = new
+            self._readAt = time.time()
+            subscribers = list(self._subscribers)
+        if old is None or old == new:
+            return False
+        LOGGER.info('Network interfaces changed: default {} -> {}'.format(old['default'], new['default']))
+        for callback in subscribers:
+            try:
+                # new is the cache, callbacks get their own copy
+                callback(old, deepcopy(new))
+            except Exception as err:
+                LOGGER.error('Network change callback failed: {}'.format(err), exc_info=True)
+        return True
+
+    def _interfaceName(self, interface, family):
+        if interface == 'default':
+            gw = self._state['default'].get(family)
+            return gw[1] if gw else None
+        return interface
+
+    def addresses(self, interface='default', family=AF_INET):
+        """ Copies of all address dicts (addr, netmask, broadcast) of the interface for family """
+        self.refresh()
+        name = self._interfaceName(interface, family)
+        return [dict(address) for address in self._state['interfaces'].get(name, {}).get(family, [])]
+
+    def get(self, interface='default', family=AF_INET):
+        """
+        The first address dict of the interface, the one with the default route
+        for 'default'. Same result as get_network_interface.
+        """
+        addresses = self.addresses(interface, family)
+        if addresses:
+            return addresses[0]
+        LOGGER.error('No {} address for interface {} in {}'.format(
+            'IPv6' if family == AF_INET6 else 'IPv4', interface, list(self._state['interfaces'])))
+        return {'addr': False, 'broadcast': False, 'netmask': False}
+
+    def gateway(self, family=AF_INET):
+        """ Address of the default gateway for family, None if there is none """
+        self.refresh()
+        gw = self._state['default'].get(family)
+        return gw[0] if gw else None
+
+    def interfaces(self):
+        self.refresh()
+        return list(self._state['interfaces'])
+
+    def subscribe(self, callback):
+        """ Call callback(old, new) on changes, starts the watcher thread """
+        with self._lock:
+            self._subscribers.append(callback)
+        self.refresh()
+        if self._watcher is None:
+            self._watcher = Thread(target=self._watch, name='NetworkInfo')
+            self._watcher.daemon = True
+            self._watcher.start()
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh(force=True)
+            except Exception as err:
+                LOGGER.error('NetworkInfo refresh failed: {}'.format(err), exc_info=True)
+
+    def stop(self):
+        self._stopped.set()
+
+
+NETWORK_INFO = NetworkInfo()
@@ -5,16 +5,17 @@ by Einstein.42 (James Milne) milne.james@gmail.com
 """
 
 import warnings
+from concurrent import futures
 from copy import deepcopy
 from dotenv import load_dotenv
 import json
+from json.encoder import encode_basestring_ascii as _encodeString
 import ssl
 import logging
 import __main__ as main
 import markdown2
 import os
 from os.path import join, expanduser
-import paho.mqtt.client as mqtt
 try:
     import queue
 except ImportError:
@@ -22,10 +23,19 @@ except ImportError:
 import re
 import sys
 import select
-from threading import Thread,current_thread
+from threading import Lock,RLock,Thread,Timer,current_thread
 import time
 import netifaces
+from paho.mqtt.client import MQTT_ERR_SUCCESS
 from .polylogger import LOGGER
+from .recorder import Recorder, percentile
+from .transport import MqttTransport, UnixSocketTransport
+from .sharding import ShardPool, ShardedNode
+from .pool import ConnectionPool
+from .netinfo import NETWORK_INFO
+from .history import DriverHistory
+from .tracing import Tracer
+from .registry import NodeRegistry, PendingNodes
 
 DEBUG = False
 PY2 = sys.version_info[0] == 2
@@ -50,25 +60,32 @@ class LoggerWriter(object):
     def flush(self):
         pass
 
-def get_network_interface(interface='default'):
+def get_network_interface(interface='default', family=netifaces.AF_INET):
         """
         Returns the network interface which contains addr, broadcasts, and netmask elements
 
-        :param interface: The interface name to check, default grabs
-        """
-        # Get the default gateway
-        gws = netifaces.gateways()
-        LOGGER.debug("gws: {}".format(gws))
-        rt = False
-        if interface in gws:
-            gwd = gws[interface][netifaces.AF_INET]
-            LOGGER.debug("gw: {}={}".format(interface,gwd))
-            ifad = netifaces.ifaddresses(gwd[1])
-            rt = ifad[netifaces.AF_INET]
-            LOGGER.debug("ifad: {}={}".format(gwd[1],rt))
-            return rt[0]
-        LOGGER.error("No {} in gateways:{}".format(interface,gws))
-        return {'addr': False, 'broadcast': False, 'netmask': False}
+        :param interface: The interface name to check, default grabs the one with the default route
+        :param family: netifaces.AF_INET or netifaces.AF_INET6
+
+        Served from polyinterface.NETWORK_INFO, which caches the lookup and can
+        notify subscribers when the addresses or default route change.
+        """
+        return NETWORK_INFO.get(interface, family)
+
+def coalesce(fun):
+    """
+    Mark a command function so bursts of it for the same node are collapsed,
+    for example slider DON commands. A newer command replaces the waiting ones
+    with the same cmd, so only the latest of a burst is run:
+
+        commands = { 'DON': polyinterface.coalesce(setOn) }
+
+    Marked commands run on a command thread of the node, not the Controller
+    input thread. While a node has commands waiting or running there, its
+    other commands are queued behind them so they still run in order.
+    """
+    fun.coalesce = True
+    return fun
 
 def init_interface():
     sys.stdout = LoggerWriter(LOGGER.debug)
@@ -119,24 +136,38 @@ class Interface(object):
 
     CUSTOM_CONFIG_DOCS_FILE_NAME = 'POLYGLOT_CONFIG.md'
     SERVER_JSON_FILE_NAME = 'server.json';
+    # Seconds of quiet before pending customData/customParams are published,
+    # and the longest a save is held back while updates keep coming.
+    SAVE_DEBOUNCE = 0.5
+    SAVE_MAX_DELAY = 5.0
+    # Polyglot kills the NodeServer 5 seconds after asking it to stop or delete
+    SHUTDOWN_BUDGET = 4.0
+    # Order inQueue is handled in on shutdown, lowest first, the rest dropped at the deadline.
+    # config and stop never go through inQueue, they are handled by the Events thread.
+    INPUT_PRIORITY = {'command': 0, 'result': 0, 'delete': 0, 'query': 1, 'status': 1, 'shortPoll': 2, 'longPoll': 2}
 
     """
     Polyglot Interface Class
 
     :param envVar: The Name of the variable from ~/.polyglot/.env that has this NodeServer's profile number
+    :param transport: Optional transport from polyinterface.transport, defaults to MQTT
+        or to a UnixSocketTransport when POLY_UNIX_SOCKET is set
+    :param profileNum: Profile number, instead of PROFILE_NUM or envVar
+    :param host: The ProfileHost sharing its connection with this Interface, set by ProfileHost.addProfile
     """
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=unused-argument
 
     __exists = False
 
-    def __init__(self, envVar=None):
-        if self.__exists:
+    def __init__(self, envVar=None, transport=None, profileNum=None, host=None):
+        if self.__exists and host is None:
             warnings.warn('Only one Interface is allowed.')
             return
         self.config = None
         self.connected = False
-        self.profileNum = os.environ.get("PROFILE_NUM")
+        self.host = host
+        self.profileNum = profileNum if profileNum is not None else os.environ.get("PROFILE_NUM")
         if self.profileNum is None:
             if envVar is not None:
                 self.profileNum = os.environ.get(envVar)
@@ -148,38 +179,38 @@ class Interface(object):
         self.topicInput = 'udi/polyglot/ns/{}'.format(self.profileNum)
         self.topicSelfConnection = 'udi/polyglot/connections/{}'.format(self.profileNum)
         self._threads = {}
-        self._threads['socket'] = Thread(target = self._startMqtt, name = 'Interface')
-        #LOGGER.info('mqtt Client: name={}'.format(envVar))
-        self._mqttc = mqtt.Client(envVar, True)
-        # self._mqttc.will_set(self.topicSelfConnection, json.dumps({'node': self.profileNum, 'connected': False}), retain=True)
-        self._mqttc.on_connect = self._connect
-        self._mqttc.on_message = self._message
-        self._mqttc.on_subscribe = self._subscribe
-        self._mqttc.on_disconnect = self._disconnect
-        self._mqttc.on_publish = self._publish
-        self._mqttc.on_log = self._log
+        if host is None:
+            self._threads['socket'] = Thread(target = self._startMqtt, name = 'Interface')
+        self._threads['events'] = Thread(target = self._handleEvents, name = 'Events' + self.threadSuffix())
+        self._threads['events'].daemon = True
         self.useSecure = True
         if 'USE_HTTPS' in os.environ:
             self.useSecure = os.environ['USE_HTTPS']
-        if self.useSecure is True:
-            if 'MQTT_CERTPATH' in os.environ:
-                self._mqttc.tls_set(
-                    ca_certs=os.environ['MQTT_CERTPATH'] + '/polyglot.crt',
-                    certfile=os.environ['MQTT_CERTPATH'] + '/client.crt',
-                    keyfile=os.environ['MQTT_CERTPATH'] + '/client_private.key',
-                    tls_version=ssl.PROTOCOL_TLSv1_2)
+        #LOGGER.info('mqtt Client: name={}'.format(envVar))
+        if host is not None:
+            # The host owns the connection and its callbacks and routes messages to us
+            transport = host.transport
+        elif transport is None:
+            if os.environ.get('POLY_UNIX_SOCKET'):
+                LOGGER.info('Using Unix socket transport {}'.format(os.environ['POLY_UNIX_SOCKET']))
+                transport = UnixSocketTransport(os.environ['POLY_UNIX_SOCKET'], envVar)
             else:
-                self._mqttc.tls_set(
-                    ca_certs=join(expanduser("~") + '/.polyglot/ssl/polyglot.crt'),
-                    certfile=join(expanduser("~") + '/.polyglot/ssl/client.crt'),
-                    keyfile=join(expanduser("~") + '/.polyglot/ssl/client_private.key'),
-                    tls_version=ssl.PROTOCOL_TLSv1_2
-                    )
+                transport = MqttTransport(envVar, True, useSecure=self.useSecure is True)
+        self._mqttc = transport
+        # self._mqttc.will_set(self.topicSelfConnection, json.dumps({'node': self.profileNum, 'connected': False}), retain=True)
+        if host is None:
+            self._mqttc.on_connect = self._connect
+            self._mqttc.on_message = self._message
+            self._mqttc.on_subscribe = self._subscribe
+            self._mqttc.on_disconnect = self._disconnect
+            self._mqttc.on_publish = self._publish
+            self._mqttc.on_log = self._log
         # self._mqttc.tls_insecure_set(True)
         # self._mqttc.enable_logger(logger=LOGGER)
         # self.loop = asyncio.new_event_loop()
         self.loop = None
         self.inQueue = queue.Queue()
+        self.eventQueue = queue.Queue()
         # self.thread = Thread(target=self.start_loop)
         self.isyVersion = None
         self._server = os.environ.get("MQTT_HOST") or 'localhost'
@@ -187,9 +218,25 @@ class Interface(object):
         self.polyglotConnected = False
         self.__configObservers = []
         self.__stopObservers = []
-        Interface.__exists = True
+        if host is None:
+            Interface.__exists = True
         self.custom_params_docs_file_sent = False
         self.custom_params_pending_docs = ''
+        self.recorder = None
+        self.tracer = None
+        self.inputThread = None
+        self.shutdownDeadline = None
+        self._stopping = False
+        self._stopLock = Lock()
+        self._lastPublish = None
+        self._networkThread = None
+        self._saveLock = Lock()
+        self._saveTimer = None
+        self._pendingSaves = {}
+        self._pendingSince = None
+        self._savedData = {}
+        self._busy = {}
+        self._busyLock = Lock()
         try:
             self.network_interface = self.get_network_interface()
             LOGGER.info('Connect: Network Interface: {}'.format(self.network_interface))
@@ -197,6 +244,23 @@ class Interface(object):
             self.network_interface = False
             LOGGER.error('Failed to determine Network Interface', exc_info=True)
 
+    def threadSuffix(self):
+        """ Added to thread names so the threads of hosted profiles can be told apart in the log """
+        return '' if self.host is None else '-{}'.format(self.profileNum)
+
+    def profileFile(self, filename):
+        """
+        filename for this profile. When hosted the profile number is added before
+        the extension, so traffic.jsonl.gz becomes traffic-3.jsonl.gz.
+        """
+        if self.host is None:
+            return filename
+        base, ext = os.path.splitext(filename)
+        if ext == '.gz':
+            base, inner = os.path.splitext(base)
+            ext = inner + ext
+        return '{}-{}{}'.format(base, self.profileNum, ext)
+
     def onConfig(self, callback):
         """
         Gives the ability to bind any methods to be run when the config is received.
@@ -222,6 +286,7 @@ class Interface(object):
         """
         if current_thread().name != "MQTT":
             current_thread().name = "MQTT"
+        self._networkThread = current_thread()
         if rc == 0:
             self.connected = True
             results = []
@@ -254,6 +319,7 @@ class Interface(object):
         :param flags: The flags set on the connection.
         :param msg: Dictionary of MQTT received message. Uses: msg.topic, msg.qos, msg.payload
         """
+        receivedAt = time.time()
         try:
             inputCmds = ['query', 'command', 'result', 'status', 'shortPoll', 'longPoll', 'delete']
             parsed_msg = json.loads(msg.payload.decode('utf-8'))
@@ -266,14 +332,14 @@ class Interface(object):
                 for key in parsed_msg:
                     if DEBUG:
                         LOGGER.debug('MQTT Processing Message: {}: {}'.format(msg.topic, parsed_msg))
-                    if key == 'config':
-                        self.inConfig(parsed_msg[key])
-                    elif key == 'connected':
-                        self.polyglotConnected = parsed_msg[key]
+                    if key in ('config', 'connected'):
+                        self.eventQueue.put((key, parsed_msg[key]))
                     elif key == 'stop':
                         LOGGER.debug('Received stop from Polyglot... Shutting Down.')
-                        self.stop()
+                        self.eventQueue.put((key, None))
                     elif key in inputCmds:
+                        if self.tracer is not None:
+                            self.tracer.received(parsed_msg, receivedAt)
                         self.input(parsed_msg)
                     else:
                         LOGGER.error('Invalid command received in message from Polyglot: {}'.format(key))
@@ -286,6 +352,48 @@ class Interface(object):
             template = "An exception of type {0} occured. Arguments:\n{1!r}"
             message = template.format(type(ex).__name__, ex.args)
             LOGGER.error("MQTT Received Unknown Error: " + message, exc_info=True)
+        finally:
+            self.recordBusy('MQTT', time.time() - receivedAt)
+
+    def _handleEvents(self):
+        """
+        Events thread. Handles config, connected and stop messages in the order
+        received, so slow config observers don't hold up the MQTT network loop.
+        """
+        while True:
+            key, data = self.eventQueue.get()
+            started = time.time()
+            try:
+                if key == 'config':
+                    self.inConfig(data)
+                elif key == 'connected':
+                    self.polyglotConnected = data
+                elif key == 'stop':
+                    self.stop()
+            except Exception as err:
+                LOGGER.error('Events: handling {} failed: {}'.format(key, err), exc_info=True)
+            self.recordBusy('Events', time.time() - started)
+            self.eventQueue.task_done()
+
+    def recordBusy(self, thread, seconds):
+        """ Add the time a thread spent handling one message to threadStats """
+        with self._busyLock:
+            stats = self._busy.get(thread)
+            if stats is None:
+                stats = self._busy[thread] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+    def threadStats(self):
+        """
+        Dict of thread ('MQTT', 'Events', 'Input') to the number of messages it
+        handled, the total and the longest time in seconds it spent on one.
+        """
+        with self._busyLock:
+            return dict((thread, {'count': count, 'busy': busy, 'max': longest})
+                for thread, (count, busy, longest) in self._busy.items())
 
     def _disconnect(self, mqttc, userdata, rc):
         """
@@ -325,6 +433,11 @@ class Interface(object):
         pass
 
     def start(self):
+        if os.environ.get('POLY_RECORD'):
+            self.recorder = Recorder(self, self.profileFile(os.environ['POLY_RECORD'])).start()
+        if os.environ.get('POLY_TRACE'):
+            trace = os.environ['POLY_TRACE']
+            self.startTracing(None if trace == '1' else self.profileFile(trace))
         for _, thread in self._threads.items():
             thread.start()
 
@@ -351,26 +464,119 @@ class Interface(object):
                 done = True
         LOGGER.debug("MQTT Done:")
 
-    def stop(self):
+    def stop(self, budget=None):
         """
-        The client stop method. If the client is currently connected
-        stop the thread and disconnect. Publish the disconnected
-        message if clean shutdown.
+        The client stop method. Drains the input queue, runs the stop observers,
+        flushes pending saves and waits for outbound messages to be published,
+        all within budget seconds (SHUTDOWN_BUDGET by default). If the client is
+        currently connected, publish the disconnected message, stop the thread
+        and disconnect. Only the first call does anything, e.g. a delete handled
+        while draining doesn't stop again.
+
+        :param budget: Seconds the whole shutdown may take
         """
         # self.loop.call_soon_threadsafe(self.loop.stop)
         # self.loop.stop()
         # self._longPoll.cancel()
         # self._shortPoll.cancel()
+        with self._stopLock:
+            if self._stopping:
+                LOGGER.debug('stop: already stopping, ignored.')
+                return
+            self._stopping = True
+        start = time.time()
+        self.shutdownDeadline = start + (self.SHUTDOWN_BUDGET if budget is None else budget)
+        # Keep a share of the budget for observers and the final publishes
+        reserve = (self.shutdownDeadline - start) / 2.0
+        drained, dropped = self._drainInput(self.shutdownDeadline - reserve)
+        for watcher in self.__stopObservers:
+            try:
+                watcher()
+            except Exception as e:
+                LOGGER.exception('Error in stop observer: {}'.format(e), exc_info=True)
+        self.flushSaves()
+        published = True
         if self.connected:
             LOGGER.info('Disconnecting from MQTT... {}:{}'.format(self._server, self._port))
-            self._mqttc.publish(self.topicSelfConnection, json.dumps({'node': self.profileNum, 'connected': False}), retain=True)
-            self._mqttc.loop_stop()
-            self._mqttc.disconnect()
-        try:
-            for watcher in self.__stopObservers:
-                watcher()
-        except KeyError as e:
-            LOGGER.exception('KeyError in gotConfig: {}'.format(e), exc_info=True)
+            info = self._mqttc.publish(self.topicSelfConnection, json.dumps({'node': self.profileNum, 'connected': False}), qos=1, retain=True)
+            published = self._waitPublished([self._lastPublish, info], self.shutdownDeadline)
+            if self.host is None:
+                self._mqttc.loop_stop()
+                self._mqttc.disconnect()
+        if self.host is not None:
+            self.host._release(self)
+        LOGGER.info('Shutdown in {:.3f}s: {} queued inputs handled, dropped {}, outbound {}'.format(
+            time.time() - start, drained, dropped or 'none', 'flushed' if published else 'not confirmed'))
+        for thread, stats in sorted(self.threadStats().items()):
+            LOGGER.info('{} thread handled {} messages in {:.3f}s, longest {:.3f}s'.format(
+                thread, stats['count'], stats['busy'], stats['max']))
+        if self.recorder is not None:
+            self.recorder.stop()
+        if self.tracer is not None:
+            self.tracer.stop()
+
+    def startTracing(self, filename=None, maxTraces=10000):
+        """
+        Trace the latency of every input from Polyglot, see polyinterface.tracing.
+
+        :param filename: Optional JSON lines file every finished trace is written to
+        :param maxTraces: Number of traces kept for tracer.summary()
+        """
+        self.tracer = Tracer(filename, maxTraces)
+        return self.tracer
+
+    def _drainInput(self, deadline):
+        """
+        Reorder inQueue by INPUT_PRIORITY and wait for it to be handled until
+        deadline, then discard what is left. Returns the number of items handled
+        and a dict of dropped counts by message key.
+        """
+        q = self.inQueue
+        with q.mutex:
+            items = sorted(q.queue, key=lambda item: min([self.INPUT_PRIORITY.get(k, 1) for k in item] or [1]))
+            q.queue.clear()
+            q.queue.extend(items)
+            queued = len(items)
+        # The input thread can't wait on itself, e.g. when stopping for a delete
+        if self.inputThread is not None and self.inputThread is not current_thread():
+            with q.all_tasks_done:
+                while q.unfinished_tasks and time.time() < deadline:
+                    q.all_tasks_done.wait(deadline - time.time())
+        dropped = {}
+        with q.mutex:
+            left = list(q.queue)
+            q.queue.clear()
+            for item in left:
+                for key in item:
+                    dropped[key] = dropped.get(key, 0) + 1
+            q.unfinished_tasks = max(0, q.unfinished_tasks - len(left))
+            if not q.unfinished_tasks:
+                q.all_tasks_done.notify_all()
+        return queued - len(left), dropped
+
+    def _waitPublished(self, infos, deadline):
+        """
+        Wait until every publish in infos went out (or was acknowledged for qos 1).
+        A publish that failed, e.g. because it was made while disconnected, counts
+        as not published.
+        """
+        if current_thread() is self._networkThread:
+            # Publishes only go out once this callback returns to the network loop
+            return False
+        for info in infos:
+            if info is None:
+                continue
+            if getattr(info, 'rc', MQTT_ERR_SUCCESS) != MQTT_ERR_SUCCESS:
+                return False
+            try:
+                while not info.is_published():
+                    if time.time() >= deadline:
+                        return False
+                    time.sleep(0.01)
+            except (RuntimeError, ValueError) as err:
+                LOGGER.debug('Publish not confirmed: {}'.format(err))
+                return False
+        return True
 
     def send(self, message):
         """
@@ -380,11 +586,37 @@ class Interface(object):
         if not isinstance(message, dict) and self.connected:
             warnings.warn('payload not a dictionary')
             return False
+        tracer = self.tracer
+        if tracer is not None:
+            started = time.time()
         try:
             message['node'] = self.profileNum
-            self._mqttc.publish(self.topicInput, json.dumps(message), retain=False)
+            self._lastPublish = self._mqttc.publish(self.topicInput, json.dumps(message), retain=False)
         except TypeError as err:
             LOGGER.error('MQTT Send Error: {}'.format(err), exc_info=True)
+        if tracer is not None:
+            tracer.published(started)
+
+    def sendEncoded(self, payload):
+        """
+        Send a message already encoded as JSON, including the node key that send adds.
+        Used with statusTemplate so status reports skip building and encoding a dict.
+        """
+        tracer = self.tracer
+        if tracer is not None:
+            started = time.time()
+        self._lastPublish = self._mqttc.publish(self.topicInput, payload, retain=False)
+        if tracer is not None:
+            tracer.published(started)
+
+    def statusTemplate(self, address, driver):
+        """
+        Pre-encoded (prefix, suffix) of the status message for one driver of a node.
+        prefix + encoded value + ', "uom": ' + encoded uom + suffix is the same
+        JSON send would publish for that status message.
+        """
+        prefix = json.dumps({'status': {'address': address, 'driver': driver, 'value': None}})
+        return (prefix[:-len('null}}')], '}, "node": ' + json.dumps(self.profileNum) + '}')
 
     def addNode(self, node):
         """
@@ -400,7 +632,7 @@ class Interface(object):
                     'name': node.name,
                     'node_def_id': node.id,
                     'primary': node.primary,
-                    'drivers': node.drivers,
+                    'drivers': [dict(d) for d in node.drivers],
                     'hint': node.hint
                 }]
             }
@@ -414,8 +646,7 @@ class Interface(object):
         :param data: Dictionary of key value pairs to store in Polyglot database.
         """
         LOGGER.info('Sending customData to Polyglot.')
-        message = { 'customdata': data }
-        self.send(message)
+        self._queueSave('customdata', data)
 
     def saveCustomParams(self, data):
         """
@@ -424,8 +655,47 @@ class Interface(object):
         :param data: Dictionary of key value pairs to store in Polyglot database.
         """
         LOGGER.info('Sending customParams to Polyglot.')
-        message = { 'customparams': data }
-        self.send(message)
+        self._queueSave('customparams', data)
+
+    def _queueSave(self, key, data):
+        """
+        Hold a customdata or customparams save until SAVE_DEBOUNCE seconds pass
+        without another one, so a burst of updates is published once.
+        """
+        with self._saveLock:
+            self._pendingSaves[key] = deepcopy(data)
+            now = time.time()
+            if self._pendingSince is None:
+                self._pendingSince = now
+            if self._saveTimer is not None:
+                self._saveTimer.cancel()
+            delay = min(self.SAVE_DEBOUNCE, max(0, self._pendingSince + self.SAVE_MAX_DELAY - now))
+            if delay > 0:
+                self._saveTimer = Timer(delay, self.flushSaves)
+                self._saveTimer.daemon = True
+                self._saveTimer.start()
+                return
+            self._saveTimer = None
+        self.flushSaves()
+
+    def flushSaves(self):
+        """
+        Publish pending customdata and customparams now, skipping any that
+        match what Polyglot already has.
+        """
+        with self._saveLock:
+            if self._saveTimer is not None:
+                self._saveTimer.cancel()
+                self._saveTimer = None
+            pending, self._pendingSaves = self._pendingSaves, {}
+            self._pendingSince = None
+            for key, data in pending.items():
+                encoded = json.dumps(data, sort_keys=True)
+                if encoded == self._savedData.get(key):
+                    LOGGER.debug('{} unchanged, not sending to Polyglot.'.format(key))
+                    continue
+                self._savedData[key] = encoded
+                self.send({ key: data })
 
     def addNotice(self, data):
         """
@@ -496,6 +766,10 @@ class Interface(object):
         """
         self.config = config
         self.isyVersion = config['isyVersion']
+        with self._saveLock:
+            for key, configKey in (('customdata', 'customData'), ('customparams', 'customParams')):
+                if configKey in config:
+                    self._savedData[key] = json.dumps(config[configKey], sort_keys=True)
         try:
             for watcher in self.__configObservers:
                 watcher(config)
@@ -521,7 +795,7 @@ class Interface(object):
     def send_custom_config_docs(self):
         data = ''
         if not self.custom_params_docs_file_sent:
-            data = self.get_md_file_data(Interface.CUSTOM_CONFIG_DOCS_FILE_NAME)
+            data = self.get_md_file_data(self.CUSTOM_CONFIG_DOCS_FILE_NAME)
         else:
             data = self.config.get('customParamsDoc', '')
 
@@ -567,8 +841,8 @@ class Interface(object):
         message = { 'typedparams': data }
         self.send(message)
 
-    def get_network_interface(self,interface='default'):
-        return get_network_interface(interface=interface)
+    def get_network_interface(self,interface='default',family=netifaces.AF_INET):
+        return get_network_interface(interface=interface,family=family)
 
     def get_server_data(self,check_profile=True,build_profile=None):
         """
@@ -637,9 +911,68 @@ class Interface(object):
             cdata['profile_version'] = serverdata['profile_version']
             self.saveCustomData(cdata)
 
+class DriverRecord(object):
+    """
+    Compact storage for a single driver of a node running in compact mode.
+
+    Behaves like the driver dict ({'driver', 'value', 'uom'}) so existing
+    code that does d['value'] keeps working, but also carries the last value
+    and uom reported to Polyglot so a node only holds one copy of its state.
+    """
+    __slots__ = ('driver', 'value', 'uom', 'reported', 'reportedUom')
+
+    KEYS = ('driver', 'value', 'uom')
+
+    def __init__(self, driver, value, uom):
+        self.driver = driver
+        self.value = value
+        self.uom = uom
+        self.reported = value
+        self.reportedUom = uom
+
+    def __getitem__(self, key):
+        if key not in DriverRecord.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in DriverRecord.KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in DriverRecord.KEYS
+
+    def __iter__(self):
+        return iter(DriverRecord.KEYS)
+
+    def __len__(self):
+        return len(DriverRecord.KEYS)
+
+    def get(self, key, default=None):
+        if key not in DriverRecord.KEYS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return DriverRecord.KEYS
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class Node(object):
     """
     Node Class for individual devices.
+
+    Set compact = True on a Node subclass to store its drivers as DriverRecord
+    objects built from a template shared by every instance of the class,
+    instead of two deep copied lists of dicts per node. Drivers must then be
+    declared on the class, not replaced on the instance.
+
+    Set driverHistorySizes = {driver: size} to keep the last size numeric values given
+    to setDriver for those drivers, see driverHistory and
+    polyinterface.history.
     """
     def __init__(self, controller, primary, address, name):
         try:
@@ -648,6 +981,10 @@ class Node(object):
             self.primary = primary
             self.address = address
             self.name = name
+            if self.compact:
+                # Unset attributes fall back to the class defaults below
+                self.drivers = self._compactDrivers()
+                return
             self.polyConfig = None
             self.drivers = deepcopy(self.drivers)
             self._drivers = deepcopy(self.drivers)
@@ -659,6 +996,29 @@ class Node(object):
         except (KeyError) as err:
             LOGGER.error('Error Creating node: {}'.format(err), exc_info=True)
 
+    @classmethod
+    def _driverTemplate(cls):
+        """
+        Returns the immutable (template, index) pair for this class, built once
+        from the class drivers and shared by all instances.
+        """
+        template = cls.__dict__.get('_compactTemplate')
+        if template is None:
+            drivers = tuple((d['driver'], d['value'], d['uom']) for d in cls.drivers)
+            index = dict((d[0], i) for i, d in enumerate(drivers))
+            template = (drivers, index)
+            cls._compactTemplate = template
+        return template
+
+    def _compactDrivers(self):
+        return [DriverRecord(driver, value, uom) for (driver, value, uom) in self._driverTemplate()[0]]
+
+    def _driverRecord(self, driver):
+        index = self._driverTemplate()[1].get(driver)
+        if index is None:
+            return None
+        return self.drivers[index]
+
     def _convertDrivers(self, drivers):
         return deepcopy(drivers)
         """
@@ -674,6 +1034,17 @@ class Node(object):
         """
 
     def setDriver(self, driver, value, report=True, force=False, uom=None):
+        if driver in self.driverHistorySizes:
+            self._recordHistory(driver, value)
+        if self.compact:
+            d = self._driverRecord(driver)
+            if d is not None:
+                d.value = value
+                if uom is not None:
+                    d.uom = uom
+                if report:
+                    self.reportDriver(d, report, force)
+            return
         for d in self.drivers:
             if d['driver'] == driver:
                 d['value'] = value
@@ -683,7 +1054,68 @@ class Node(object):
                     self.reportDriver(d, report, force)
                 break
 
+    def _recordHistory(self, driver, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            LOGGER.debug('{} {}: not keeping history of non numeric value {}'.format(self.address, driver, value))
+            return
+        self.driverHistory(driver).append(value)
+
+    def driverHistory(self, driver):
+        """
+        The DriverHistory of driver, empty until setDriver is first called for it.
+        None when driver is not listed in the driverHistorySizes class attribute.
+        """
+        if driver not in self.driverHistorySizes:
+            return None
+        buffers = self.__dict__.setdefault('_history', {})
+        history = buffers.get(driver)
+        if history is None:
+            history = buffers.setdefault(driver, DriverHistory(self.driverHistorySizes[driver]))
+        return history
+
+    def _buildStatusTemplates(self):
+        """ Pre-encode the status message of every driver, done when the node is added """
+        poly = self.controller.poly
+        if getattr(poly, 'statusTemplate', None) is None:
+            return
+        self._statusTemplates = dict((d['driver'], poly.statusTemplate(self.address, d['driver'])) for d in self.drivers)
+
+    def _publishStatus(self, driver):
+        """ Publish a status message, from the pre-encoded template when the node has one """
+        templates = self.__dict__.get('_statusTemplates')
+        if templates is None:
+            return False
+        template = templates.get(driver['driver'])
+        if template is None:
+            template = templates[driver['driver']] = self.controller.poly.statusTemplate(self.address, driver['driver'])
+        uom = driver['uom']
+        self.controller.poly.sendEncoded(''.join((template[0], _encodeString(str(driver['value'])), ', "uom": ',
+            str(uom) if type(uom) is int else json.dumps(uom), template[1])))
+        return True
+
     def reportDriver(self, driver, report, force):
+        if self.compact:
+            d = self._driverRecord(driver['driver'])
+            if d is not None and (str(d.reported) != str(driver['value']) or
+                    d.reportedUom != driver['uom'] or
+                    force):
+                LOGGER.info('Updating Driver {} - {}: {}, uom: {}'.format(self.address, driver['driver'], driver['value'], driver['uom']))
+                d.reported = driver['value']
+                d.reportedUom = driver['uom']
+                if self._publishStatus(driver):
+                    return
+                message = {
+                    'status': {
+                        'address': self.address,
+                        'driver': driver['driver'],
+                        'value': str(driver['value']),
+                        'uom': driver['uom']
+                    }
+                }
+                self.controller.poly.send(message)
+            return
         for d in self._drivers:
             if (d['driver'] == driver['driver'] and
                 (str(d['value']) != str(driver['value']) or
@@ -693,6 +1125,8 @@ class Node(object):
                 d['value'] = deepcopy(driver['value'])
                 if d['uom'] != driver['uom']:
                     d['uom'] = deepcopy(driver['uom'])
+                if self._publishStatus(driver):
+                    break
                 message = {
                     'status': {
                         'address': self.address,
@@ -731,6 +1165,13 @@ class Node(object):
             self.controller.poly.send(message)
 
     def updateDrivers(self, drivers):
+        if self.compact:
+            for driver in drivers:
+                d = self._driverRecord(driver['driver'])
+                if d is not None:
+                    d.reported = driver['value']
+                    d.reportedUom = driver['uom']
+            return
         self._drivers = deepcopy(drivers)
 
     def query(self):
@@ -742,7 +1183,42 @@ class Node(object):
     def runCmd(self, command):
         if command['cmd'] in self.commands:
             fun = self.commands[command['cmd']]
-            fun(self, command)
+            if getattr(fun, 'coalesce', False) or self.__dict__.get('_commandWorker'):
+                self._queueCommand(fun, command)
+            else:
+                fun(self, command)
+
+    def _queueCommand(self, fun, command):
+        """
+        Run a command on the node's command thread after the ones already
+        waiting, so the commands of a node run in the order received. A command
+        marked with coalesce replaces the waiting commands with the same cmd.
+        """
+        with Node._coalesceLock:
+            waiting = self.__dict__.setdefault('_commandQueue', [])
+            if getattr(fun, 'coalesce', False):
+                replaced = [entry for entry in waiting if entry[1]['cmd'] == command['cmd']]
+                for entry in replaced:
+                    waiting.remove(entry)
+                if replaced:
+                    LOGGER.debug('{} {} replaced by a newer command'.format(self.address, command['cmd']))
+            waiting.append((fun, command))
+            if self.__dict__.get('_commandWorker'):
+                return
+            self._commandWorker = True
+        Thread(target=self._runCommands, name='Cmd-{}'.format(self.address)).start()
+
+    def _runCommands(self):
+        while True:
+            with Node._coalesceLock:
+                if not self._commandQueue:
+                    self._commandWorker = False
+                    return
+                fun, command = self._commandQueue.pop(0)
+            try:
+                fun(self, command)
+            except Exception as err:
+                LOGGER.error('runCmd: failed {}.{} {}'.format(self.address, command['cmd'], err), exc_info=True)
 
     def start(self):
         pass
@@ -766,11 +1242,34 @@ class Node(object):
     drivers = []
     sends = {}
     hint = [ 0, 0, 0, 0 ]
+    compact = False
+    driverHistorySizes = {}
+    _coalesceLock = Lock()
+    polyConfig = None
+    isPrimary = None
+    config = None
+    timeAdded = None
+    enabled = None
+    added = None
 
 
 class Controller(Node):
     """
     Controller Class for controller management. Superclass of Node
+
+    self.connections is a ConnectionPool nodes can borrow device connections
+    from, it is closed when the NodeServer stops or is deleted.
+
+    Set snapshotFile to a path to keep a copy of the last config there and
+    start from it on the next restart, before Polyglot sends the config, see
+    warmStart.
+
+    Set shards to a number of worker processes to run nodes added with
+    addShardedNode outside of this process, see polyinterface.sharding.
+
+    self.nodes and self._nodes are copy-on-write NodeRegistry dicts that any
+    thread can iterate while nodes are added or removed, see
+    polyinterface.registry.
     """
     __exists = False
 
@@ -784,32 +1283,60 @@ class Controller(Node):
             self.poly = poly
             self.poly.onConfig(self._gotConfig)
             self.poly.onStop(self.stop)
+            self.poly.onStop(self._drainStatus)
+            self.connections = ConnectionPool()
+            self._deleting = False
+            self.poly.onStop(self._closeConnections)
             self.name = name
             self.address = 'controller'
             self.primary = self.address
-            self._drivers = deepcopy(self.drivers)
-            self._nodes = {}
+            if self.compact:
+                self.drivers = self._compactDrivers()
+            else:
+                self._drivers = deepcopy(self.drivers)
+            self._nodes = NodeRegistry()
             self.config = None
-            self.nodes = { self.address: self }
+            self.nodes = NodeRegistry({ self.address: self })
             self._threads = {}
-            self._threads['input'] = Thread(target = self._parseInput, name = 'Controller')
-            self._threads['ns']  = Thread(target = self.start, name = 'NodeServer')
+            suffix = poly.threadSuffix() if hasattr(poly, 'threadSuffix') else ''
+            self._threads['input'] = Thread(target = self._parseInput, name = 'Controller' + suffix)
+            self._threads['ns']  = Thread(target = self.start, name = 'NodeServer' + suffix)
+            self._threads['status'] = Thread(target = self._sendStatus, name = 'Status' + suffix)
+            self._statusQueue = queue.Queue()
             self.polyConfig = None
             self.isPrimary = None
             self.timeAdded = None
             self.enabled = None
             self.added = None
             self.started = False
-            self.nodesAdding = []
+            self.nodesAdding = PendingNodes()
+            self._shardPool = None
+            self._pollExecutor = None
+            self._pollBusy = set()
+            self._warm = False
+            self._warmTried = False
+            # Held while a config is applied, so a warm start and Polyglot's config don't interleave
+            self._configLock = RLock()
+            self._warmConfig = None
+            self._warmAdds = []
+            self._snapshotWritten = None
             # self._threads = []
             self._startThreads()
         except (KeyError) as err:
             LOGGER.error('Error Creating node: {}'.format(err), exc_info=True)
 
     def _gotConfig(self, config):
+        with self._configLock:
+            self._applyConfig(config)
+
+    def _applyConfig(self, config):
+        reconcile = self._warm and config is not self._warmConfig
+        if reconcile:
+            LOGGER.info('Config received from Polyglot, reconciling warm start.')
+            self._warm = False
         self.polyConfig = config
+        self._nodes.update((node['address'], node) for node in config['nodes'])
         for node in config['nodes']:
-            self._nodes[node['address']] = node
             if node['address'] in self.nodes:
                 n = self.nodes[node['address']]
                 n.updateDrivers(node['drivers'])
@@ -818,6 +1345,9 @@ class Controller(Node):
                 n.timeAdded = node['timeAdded']
                 n.enabled = node['enabled']
                 n.added = node['added']
+        if self._shardPool is not None:
+            self._shardPool.config([node for node in config['nodes']
+                if isinstance(self.nodes.get(node['address']), ShardedNode)])
         if self.address not in self._nodes:
             self.addNode(self)
             LOGGER.info('Waiting on Controller node to be added.......')
@@ -826,15 +1356,107 @@ class Controller(Node):
             self.started = True
             # self.setDriver('ST', 1, True, True)
             self._threads['ns'].start()
+        if reconcile:
+            adds, self._warmAdds = self._warmAdds, []
+            for node in adds:
+                if self.nodes.get(node.address) is node:
+                    self.poly.addNode(node)
+            # Report anything that changed while running from the snapshot
+            self.reportAllDrivers()
+        if not self._warm and self.snapshotFile:
+            self._writeSnapshot(config)
+
+    def _writeSnapshot(self, config):
+        """
+        Save the nodes, drivers and custom settings from config to snapshotFile
+        when they differ from the last snapshot written.
+        """
+        snapshot = {
+            'isyVersion': config.get('isyVersion'),
+            'customParams': config.get('customParams', {}),
+            'customData': config.get('customData', {}),
+            'notices': config.get('notices', {}),
+            'nodes': [[n['address'], n.get('name'), n.get('node_def_id'), n.get('primary'),
+                n.get('isprimary'), n.get('enabled'), n.get('added'), n.get('timeAdded'),
+                [[d['driver'], d['value'], d['uom']] for d in n.get('drivers', [])]]
+                for n in config.get('nodes', [])]
+        }
+        try:
+            data = json.dumps(snapshot, separators=(',', ':'))
+            if data == self._snapshotWritten:
+                return
+            tmp = self.snapshotFile + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.rename(tmp, self.snapshotFile)
+            self._snapshotWritten = data
+        except (IOError, OSError, TypeError) as err:
+            LOGGER.error('Failed to write config snapshot {}: {}'.format(self.snapshotFile, err))
+
+    def warmStart(self):
+        """
+        Start the NodeServer from snapshotFile without waiting for Polyglot.
+        Node adds are held until the real config arrives and then reconciled.
+
+        Called by runForever, call it after creating the Controller when not
+        using runForever. Does nothing without a snapshotFile, once the config
+        arrived or when called again.
+        """
+        if not self.snapshotFile or self._warmTried or self.polyConfig is not None:
+            return
+        self._warmTried = True
+        try:
+            data, config = self._readSnapshot()
+        except (IOError, OSError, ValueError) as err:
+            LOGGER.info('No config snapshot to warm start from: {}'.format(err))
+            return
+        with self._configLock:
+            if self.polyConfig is not None:
+                LOGGER.info('Config received from Polyglot while reading {}, not warm starting.'.format(self.snapshotFile))
+                return
+            LOGGER.info('Warm start from {} with {} nodes'.format(self.snapshotFile, len(config['nodes'])))
+            self._snapshotWritten = data
+            self._warm = True
+            self._warmConfig = config
+            if self.poly.config is None:
+                self.poly.config = config
+                self.poly.isyVersion = config['isyVersion']
+            self._applyConfig(config)
+
+    def _readSnapshot(self):
+        """ (file contents, config) from snapshotFile """
+        with open(self.snapshotFile) as f:
+            data = f.read()
+        snapshot = json.loads(data)
+        config = {
+            'isyVersion': snapshot.get('isyVersion'),
+            'customParams': snapshot.get('customParams', {}),
+            'customData': snapshot.get('customData', {}),
+            'notices': snapshot.get('notices', {}),
+            'customParamsDoc': '',
+            'nodes': [{
+                'address': n[0], 'name': n[1], 'node_def_id': n[2], 'primary': n[3],
+                'isprimary': n[4], 'enabled': n[5], 'added': n[6], 'timeAdded': n[7],
+                'drivers': [{'driver': d[0], 'value': d[1], 'uom': d[2]} for d in n[8]]
+            } for n in snapshot.get('nodes', [])]
+        }
+        return data, config
 
     def _startThreads(self):
         self._threads['input'].daemon = True
         self._threads['ns'].daemon = True
+        self._threads['status'].daemon = True
+        self.poly.inputThread = self._threads['input']
         self._threads['input'].start()
+        self._threads['status'].start()
 
     def _parseInput(self):
         while True:
             input = self.poly.inQueue.get()
+            started = time.time()
+            tracer = getattr(self.poly, 'tracer', None)
+            if tracer is not None:
+                tracer.dispatched(input)
             for key in input:
                 if key == 'command':
                     if input[key]['address'] in self.nodes:
@@ -850,8 +1472,12 @@ class Controller(Node):
                     self._delete()
                 elif key == 'shortPoll':
                     self.shortPoll()
+                    if self._shardPool is not None:
+                        self._shardPool.broadcast(('shortPoll',))
                 elif key == 'longPoll':
                     self.longPoll()
+                    if self._shardPool is not None:
+                        self._shardPool.broadcast(('longPoll',))
                 elif key == 'query':
                     if input[key]['address'] in self.nodes:
                         self.nodes[input[key]['address']].query()
@@ -862,6 +1488,11 @@ class Controller(Node):
                         self.nodes[input[key]['address']].status()
                     elif input[key]['address'] == 'all':
                         self.status()
+            if tracer is not None:
+                tracer.finished(input)
+            recordBusy = getattr(self.poly, 'recordBusy', None)
+            if recordBusy is not None:
+                recordBusy('Input', time.time() - started)
             self.poly.inQueue.task_done()
 
     def _handleResult(self, result):
@@ -883,8 +1514,15 @@ class Controller(Node):
         """
         Intermediate message that stops MQTT before sending to overrideable method for delete.
         """
+        # delete() may still use self.connections, _closeConnections leaves them open
+        self._deleting = True
         self.poly.stop()
         self.delete()
+        self.connections.close()
+
+    def _closeConnections(self):
+        if not self._deleting:
+            self.connections.close()
 
     def _convertDrivers(self, drivers):
         return deepcopy(drivers)
@@ -912,29 +1550,61 @@ class Controller(Node):
     If update is True, overwrite the node in Polyglot
     """
     def addNode(self, node, update=False):
-        if node.address in self._nodes:
+        if node.address in self._nodes and node.compact:
+            for existing in self._nodes[node.address]['drivers']:
+                d = node._driverRecord(existing['driver'])
+                if d is not None:
+                    d.value = existing['value']
+                    d.reported = existing['value']
+                    d.reportedUom = existing['uom']
+        elif node.address in self._nodes:
             node._drivers = self._nodes[node.address]['drivers']
+            existing = dict((d['driver'], d) for d in node._drivers)
             for driver in node.drivers:
-                for existing in self._nodes[node.address]['drivers']:
-                    if driver['driver'] == existing['driver']:
-                        driver['value'] = existing['value']
-                        # JIMBO SAYS NO
-                        # driver['uom'] = existing['uom']
+                if driver['driver'] in existing:
+                    driver['value'] = existing[driver['driver']]['value']
+                    # JIMBO SAYS NO
+                    # driver['uom'] = existing['uom']
         self.nodes[node.address] = node
+        if isinstance(node, Node):
+            node._buildStatusTemplates()
         # if node.address not in self._nodes or update:
         self.nodesAdding.append(node.address)
-        self.poly.addNode(node)
+        if self._warm:
+            self._warmAdds.append(node)
+        else:
+            self.poly.addNode(node)
         # else:
         #    self.nodes[node.address].start()
         return node
 
+    def addShardedNode(self, cls, primary, address, name, *args, **kwargs):
+        """
+        Add a node that runs in one of the shard worker processes.
+
+        :param cls: The Node class, created in the shard as cls(controller, primary, address, name, *args, **kwargs)
+        """
+        if not self.shards:
+            LOGGER.error('addShardedNode: shards is not set, adding {} in process.'.format(address))
+            return self.addNode(cls(self, primary, address, name, *args, **kwargs))
+        if self._shardPool is None:
+            self._shardPool = ShardPool(self.poly, self.shards).start()
+            self.poly.onStop(self._shardPool.stop)
+        self._shardPool.add(cls, primary, address, name, args, kwargs)
+        if address in self._nodes:
+            self._shardPool.config([self._nodes[address]])
+        return self.addNode(ShardedNode(self, self._shardPool, cls, primary, address, name))
+
     """
     Forces a full overwrite of the node
     """
     def updateNode(self, node):
         self.nodes[node.address] = node
         self.nodesAdding.append(node.address)
-        self.poly.addNode(node)
+        if self._warm:
+            self._warmAdds.append(node)
+        else:
+            self.poly.addNode(node)
 
     def delNode(self, address):
         """
@@ -942,6 +1612,8 @@ class Controller(Node):
         in our config anywhere. Usually used for normalization.
         """
         if address in self.nodes:
+            if isinstance(self.nodes[address], ShardedNode):
+                self._shardPool.send(address, ('remove', address))
             del self.nodes[address]
         self.poly.delNode(address)
 
@@ -951,15 +1623,166 @@ class Controller(Node):
     def shortPoll(self):
         pass
 
+    def pollNodes(self, poll, nodes=None, workers=8, timeout=10):
+        """
+        Poll many nodes concurrently and apply the results on the calling thread.
+
+        :param poll: Called as poll(node) on a worker thread, or the name of a node method
+            to call. Returns a dict of {driver: value} to set with setDriver, or None.
+        :param nodes: Nodes to poll, defaults to every node except the controller
+        :param workers: Maximum number of polls running at the same time, set by the first call
+        :param timeout: Seconds a single poll may run before it is given up on, and
+            that a poll may wait for a free worker before it is cancelled
+
+        Returns a summary dict with counts, failures, timeouts and latencies. A poll
+        that timed out keeps its worker until it returns and its node is skipped in
+        the following cycles until then.
+        """
+        if nodes is None:
+            nodes = [node for node in list(self.nodes.values()) if node is not self]
+        if self._pollExecutor is None:
+            self._pollExecutor = futures.ThreadPoolExecutor(max_workers=workers)
+            self.poly.onStop(lambda: self._pollExecutor.shutdown(wait=False))
+        started = {}
+        latencies = []
+        summary = {'nodes': len(nodes), 'ok': 0, 'failed': {}, 'timedOut': [], 'skipped': []}
+
+        def run(node):
+            started[node.address] = time.time()
+            try:
+                if isinstance(poll, string_types):
+                    return getattr(node, poll)()
+                return poll(node)
+            finally:
+                latencies.append(time.time() - started[node.address])
+
+        begin = time.time()
+        pending = {}
+        for node in nodes:
+            if node.address in self._pollBusy:
+                summary['skipped'].append(node.address)
+                continue
+            self._pollBusy.add(node.address)
+            pending[self._pollExecutor.submit(run, node)] = node
+        while pending:
+            done, _ = futures.wait(pending, timeout=0.1, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                node = pending.pop(future)
+                self._pollBusy.discard(node.address)
+                try:
+                    result = future.result()
+                    if result:
+                        for driver, value in result.items():
+                            node.setDriver(driver, value)
+                    summary['ok'] += 1
+                except Exception as err:
+                    LOGGER.error('pollNodes: {} failed: {}'.format(node.address, err), exc_info=True)
+                    summary['failed'][node.address] = repr(err)
+            now = time.time()
+            for future, node in list(pending.items()):
+                if node.address not in started:
+                    # Still queued, e.g. behind hung polls holding every worker
+                    if now - begin > timeout and future.cancel():
+                        LOGGER.error('pollNodes: {} not started within {}s, all workers busy'.format(node.address, timeout))
+                        summary['timedOut'].append(node.address)
+                        del pending[future]
+                        self._pollBusy.discard(node.address)
+                elif now - started[node.address] > timeout:
+                    LOGGER.error('pollNodes: {} timed out after {}s'.format(node.address, timeout))
+                    summary['timedOut'].append(node.address)
+                    del pending[future]
+                    future.add_done_callback(lambda f, address=node.address: self._pollBusy.discard(address))
+        summary['elapsed'] = time.time() - begin
+        summary['latency'] = {
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else 0.0,
+        }
+        LOGGER.info('pollNodes: {nodes} nodes in {elapsed:.3f}s, {ok} ok, {0} failed, {1} timed out, {2} skipped'.format(
+            len(summary['failed']), len(summary['timedOut']), len(summary['skipped']), **summary))
+        return summary
+
     def query(self):
-        for node in self.nodes:
-            self.nodes[node].reportDrivers()
+        self.reportAllDrivers(full=True)
 
     def status(self):
-        for node in self.nodes:
-            self.nodes[node].reportDrivers()
+        self.reportAllDrivers()
+
+    def reportAllDrivers(self, full=False):
+        """
+        Report the drivers of every node for a query or status of 'all'.
+
+        Builds a snapshot of the drivers whose value or uom differs from what
+        was last reported, or of all of them when full is True, and hands it
+        to the Status thread in chunks of statusChunkSize so the input thread
+        is not held up while thousands of status messages are published.
+        """
+        snapshot = []
+        skipped = 0
+        for node in list(self.nodes.values()):
+            if isinstance(node, ShardedNode):
+                node.reportDrivers()
+                continue
+            if node.compact:
+                reported = None
+            else:
+                reported = dict((d['driver'], d) for d in node._drivers)
+            for d in node.drivers:
+                last = d if reported is None else reported.get(d['driver'])
+                if last is not None and not full:
+                    lastValue = last.reported if reported is None else last['value']
+                    lastUom = last.reportedUom if reported is None else last['uom']
+                    if str(lastValue) == str(d['value']) and lastUom == d['uom']:
+                        skipped += 1
+                        continue
+                snapshot.append((node, d, last))
+        LOGGER.info('Reporting {} drivers to ISY, {} unchanged skipped'.format(len(snapshot), skipped))
+        for i in range(0, len(snapshot), self.statusChunkSize):
+            self._statusQueue.put(snapshot[i:i + self.statusChunkSize])
+
+    def _drainStatus(self):
+        """ Stop observer, give queued driver reports until the shutdown deadline to go out """
+        deadline = getattr(self.poly, 'shutdownDeadline', None) or time.time()
+        q = self._statusQueue
+        with q.all_tasks_done:
+            while q.unfinished_tasks and time.time() < deadline:
+                q.all_tasks_done.wait(deadline - time.time())
+        if q.unfinished_tasks:
+            LOGGER.warning('{} chunks of driver reports not sent before shutdown'.format(q.unfinished_tasks))
+
+    def _sendStatus(self):
+        """
+        Status thread, publishes the chunks queued by reportAllDrivers. Values
+        are read when sent so a newer setDriver is never overwritten by an older one.
+        """
+        while True:
+            chunk = self._statusQueue.get()
+            for node, d, last in chunk:
+                value, uom = d['value'], d['uom']
+                status = {
+                    'address': node.address,
+                    'driver': d['driver'],
+                    'value': str(value),
+                    'uom': uom
+                }
+                try:
+                    if not node._publishStatus(status):
+                        self.poly.send({ 'status': status })
+                except Exception as err:
+                    LOGGER.error('_sendStatus: {} {} failed: {}'.format(node.address, d['driver'], err), exc_info=True)
+                    continue
+                if last is None:
+                    continue
+                if node.compact:
+                    last.reported = value
+                    last.reportedUom = uom
+                else:
+                    last['value'] = value
+                    last['uom'] = uom
+            self._statusQueue.task_done()
 
     def runForever(self):
+        self.warmStart()
         self._threads['input'].join()
 
     def start(self):
@@ -1000,29 +1823,67 @@ class Controller(Node):
 
     def addNotice(self, data, key=None):
         if not isinstance(data, dict):
-            self.poly.addNotice({ 'key': key, 'value': data})
+            if key is None:
+                self.poly.addNotice({ 'key': key, 'value': data})
+            else:
+                self._applyNotices({ str(key): data }, [])
         else:
             if 'value' in data:
-                self.poly.addNotice(data)
+                if data.get('key') is None:
+                    self.poly.addNotice(data)
+                else:
+                    self._applyNotices({ str(data['key']): data['value'] }, [])
             else:
-                for key, value in data.items():
-                    self.poly.addNotice({ 'key': key, 'value': value })
+                self._applyNotices(dict((str(k), v) for k, v in data.items()), [])
 
     def removeNotice(self, key):
-        data = { 'key': str(key) }
-        self.poly.removeNotice(data)
+        self._applyNotices({}, [str(key)])
 
     def getNotices(self):
         return self.poly.config['notices']
 
+    def setNotices(self, notices):
+        """
+        Make the notices shown in the front-end match notices, a dict of key: text,
+        sending only the removenotice and addnotice messages needed to get there.
+        """
+        current = self._currentNotices()
+        notices = dict((str(k), v) for k, v in notices.items())
+        self._applyNotices(notices, [key for key in current if key not in notices])
+
     def removeNoticesAll(self):
-        if type(self.poly.config['notices']) == dict:
-            for key in self.poly.config['notices'].keys():
-                self.removeNotice(key)
-        else:
-            if len(self.poly.config['notices']):
-                for i in range(len(self.poly.config['notices'])):
-                    self.removeNotice(i)
+        self.setNotices({})
+
+    def _currentNotices(self):
+        """ Notices from the last config as a dict, None if we don't have a config yet """
+        if self.poly.config is None or 'notices' not in self.poly.config:
+            return None
+        notices = self.poly.config['notices']
+        if isinstance(notices, dict):
+            return dict((str(k), v) for k, v in notices.items())
+        return dict((str(i), v) for i, v in enumerate(notices))
+
+    def _applyNotices(self, adds, removes):
+        """
+        Send the adds and removes that change something compared to the current
+        notices, and keep the local copy in sync until Polyglot sends a new config.
+        """
+        current = self._currentNotices()
+        known = current is not None
+        if current is None:
+            current = {}
+        for key in removes:
+            if known and key not in current:
+                continue
+            self.poly.removeNotice({ 'key': key })
+            current.pop(key, None)
+        for key, value in adds.items():
+            if known and key in current and current[key] == value:
+                continue
+            self.poly.addNotice({ 'key': key, 'value': value })
+            current[key] = value
+        if known and isinstance(self.poly.config['notices'], dict):
+            self.poly.config['notices'] = current
 
     def stop(self):
         """ Called on nodeserver stop """
@@ -1031,6 +1892,9 @@ class Controller(Node):
     id = 'controller'
     commands = {}
     drivers = [{'driver': 'ST', 'value': 0, 'uom': 2}]
+    shards = 0
+    statusChunkSize = 200
+    snapshotFile = None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Pooled device connections shared by the nodes of a NodeServer.
+
+The Controller owns a ConnectionPool as self.connections. Register how to
+open a connection for an endpoint key once, then borrow it from any node:
+
+    self.controller.connections.register('hub', lambda: http.client.HTTPConnection(host, timeout=10))
+    with self.controller.connections.connection('hub') as conn:
+        conn.request('GET', '/status')
+        data = conn.getresponse().read()
+
+Connections are kept open between uses up to maxPerKey per endpoint and
+maxTotal overall, and closed after idleTimeout seconds unused. A connection
+is discarded instead of returned to the pool when the with block raises.
+"""
+
+import time
+from threading import Condition, Event, Thread
+from .polylogger import LOGGER
+
+
+class PoolTimeout(Exception):
+    """ Raised when no connection became available in time """
+    pass
+
+
+class _Endpoint(object):
+    def __init__(self, factory, close):
+        self.factory = factory
+        self.close = close
+        self.idle = []
+        self.inUse = 0
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0, 'discarded': 0, 'waits': 0}
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive connections by endpoint key.
+
+    :param maxPerKey: Maximum open connections per endpoint
+    :param maxTotal: Maximum open connections over all endpoints
+    :param idleTimeout: Seconds an unused connection is kept open
+    """
+    def __init__(self, maxPerKey=4, maxTotal=32, idleTimeout=60):
+        self.maxPerKey = maxPerKey
+        self.maxTotal = maxTotal
+        self.idleTimeout = idleTimeout
+        self._endpoints = {}
+        self._cond = Condition()
+        self._closed = False
+        self._stopped = Event()
+        self._reaper = None
+
+    def register(self, key, factory, close=None):
+        """
+        :param key: Endpoint key, e.g. 'hub' or 'host:port'
+        :param factory: Called with no arguments to open a new connection
+        :param close: Called with a connection to close it, defaults to conn.close()
+        """
+        with self._cond:
+            if key not in self._endpoints:
+                self._endpoints[key] = _Endpoint(factory, close or (lambda conn: conn.close()))
+            else:
+                self._endpoints[key].factory = factory
+
+    def _total(self):
+        return sum(len(e.idle) + e.inUse for e in self._endpoints.values())
+
+    def _evictOne(self):
+        """ Close the oldest idle connection of any endpoint to make room, caller holds the lock """
+        oldest = None
+        for endpoint in self._endpoints.values():
+            if endpoint.idle and (oldest is None or endpoint.idle[0][1] < oldest.idle[0][1]):
+                oldest = endpoint
+        if oldest is None:
+            return False
+        conn, _ = oldest.idle.pop(0)
+        oldest.stats['evicted'] += 1
+        self._close(oldest, conn)
+        return True
+
+    def _close(self, endpoint, conn):
+        try:
+            endpoint.close(conn)
+        except Exception as err:
+            LOGGER.debug('ConnectionPool: error closing connection: {}'.format(err))
+
+    def acquire(self, key, timeout=None):
+        """ Borrow a connection for key, waiting up to timeout seconds for a free slot """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            if self._closed:
+                raise PoolTimeout('ConnectionPool is closed')
+            endpoint = self._endpoints[key]
+            while True:
+                if endpoint.idle:
+                    conn, _ = endpoint.idle.pop()
+                    endpoint.inUse += 1
+                    endpoint.stats['reused'] += 1
+                    return conn
+                if endpoint.inUse < self.maxPerKey and (self._total() < self.maxTotal or self._evictOne()):
+                    endpoint.inUse += 1
+                    break
+                endpoint.stats['waits'] += 1
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout('No connection available for {}'.format(key))
+                self._cond.wait(remaining)
+                if self._closed:
+                    raise PoolTimeout('ConnectionPool is closed')
+        try:
+            conn = endpoint.factory()
+        except Exception:
+            with self._cond:
+                endpoint.inUse -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            endpoint.stats['created'] += 1
+        self._startReaper()
+        return conn
+
+    def release(self, key, conn, discard=False):
+        """ Return a borrowed connection, closing it when discard is True or the pool is closed """
+        with self._cond:
+            endpoint = self._endpoints[key]
+            endpoint.inUse -= 1
+            if discard or self._closed:
+                endpoint.stats['discarded'] += 1
+                self._close(endpoint, conn)
+            else:
+                endpoint.idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def connection(self, key, timeout=None):
+        """ Context manager that borrows a connection and returns it, or discards it on error """
+        return _Borrowed(self, key, timeout)
+
+    def evictIdle(self):
+        """ Close connections unused for longer than idleTimeout """
+        cutoff = time.time() - self.idleTimeout
+        with self._cond:
+            for endpoint in self._endpoints.values():
+                while endpoint.idle and endpoint.idle[0][1] < cutoff:
+                    conn, _ = endpoint.idle.pop(0)
+                    endpoint.stats['evicted'] += 1
+                    self._close(endpoint, conn)
+            self._cond.notify_all()
+
+    def _startReaper(self):
+        if self._reaper is None:
+            self._reaper = Thread(target=self._reap, name='ConnPool')
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _reap(self):
+        while not self._stopped.wait(max(self.idleTimeout / 2.0, 1)):
+            self.evictIdle()
+
+    def stats(self):
+        """ Dict of open, idle and in use connections and counters per endpoint key """
+        with self._cond:
+            result = {}
+            for key, endpoint in self._endpoints.items():
+                result[key] = dict(endpoint.stats, idle=len(endpoint.idle), inUse=endpoint.inUse,
+                    open=len(endpoint.idle) + endpoint.inUse)
+            return result
+
+    def close(self):
+        """ Close all idle connections, borrowed ones are closed when released """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._stopped.set()
+            for endpoint in self._endpoints.values():
+                for conn, _ in endpoint.idle:
+                    self._close(endpoint, conn)
+                endpoint.idle = []
+            self._cond.notify_all()
+        LOGGER.info('ConnectionPool closed: {}'.format(self.stats()))
+
+
+class _Borrowed(object):
+    def __init__(self, pool, key, timeout):
+        self.pool = pool
+        self.key = key
+        self.timeout = timeout
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.acquire(self.key, self.timeout)
+        return self.conn
+
+    def __exit__(self, excType, exc, tb):
+        self.pool.release(self.key, self.conn, discard=excType is not None)
+        return False
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Record and replay MQTT traffic between Polyglot and a NodeServer.
+
+The Recorder hooks Interface._message, send and sendEncoded and writes every
+inbound and outbound message as one JSON line:
+
+    [seconds since start, "in" or "out", topic, payload]
+
+Files ending in .gz are gzip compressed. The Replayer feeds the inbound
+messages of a recording back into an Interface at the original speed, a
+multiple of it, or as fast as possible, then reports handler latencies
+and the difference between the recorded and the produced outbound messages.
+"""
+
+import gzip
+import json
+import sys
+import time
+from collections import Counter
+from threading import Lock
+from .polylogger import LOGGER
+
+
+def _open(filename, mode):
+    """ Text file for JSON lines, gzip compressed when filename ends in .gz """
+    if not filename.endswith('.gz'):
+        return open(filename, mode)
+    if sys.version_info[0] < 3:
+        # Python 2 gzip has no text mode, its str lines are what json reads and writes
+        return gzip.open(filename, mode + 'b')
+    return gzip.open(filename, mode + 't', encoding='utf-8')
+
+
+def _restore(obj, name, previous):
+    """ Put back an instance attribute replaced by a hook, or fall back to the class """
+    if previous is None:
+        obj.__dict__.pop(name, None)
+    else:
+        setattr(obj, name, previous)
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of a list of numbers, 0.0 if empty """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+class RecordedMessage(object):
+    """ Minimal stand in for paho's MQTTMessage """
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class Recorder(object):
+    """
+    Capture MQTT traffic of an Interface to a file.
+
+    :param poly: The Interface to record
+    :param filename: File to write, gzip compressed when it ends in .gz
+    """
+    def __init__(self, poly, filename):
+        self.poly = poly
+        self.filename = filename
+        self.count = 0
+        self._file = None
+        self._lock = Lock()
+        self._start = None
+        self._message = None
+        self._send = None
+        self._sendEncoded = None
+        self._hooked = (None, None, None)
+
+    def start(self):
+        LOGGER.info('Recording MQTT traffic to {}'.format(self.filename))
+        self._file = _open(self.filename, 'w')
+        self._start = time.time()
+        self._message = self.poly._message
+        self._send = self.poly.send
+        self._sendEncoded = self.poly.sendEncoded
+        self._hooked = (self.poly.__dict__.get('_message'), self.poly.__dict__.get('send'),
+            self.poly.__dict__.get('sendEncoded'))
+        self.poly._message = self._recordMessage
+        self.poly.send = self._recordSend
+        self.poly.sendEncoded = self._recordSendEncoded
+        if self._ownsTransport():
+            self.poly._mqttc.on_message = self._recordMessage
+        return self
+
+    def _ownsTransport(self):
+        """ False when a ProfileHost owns the transport and routes messages to poly._message """
+        return getattr(self.poly, 'host', None) is None and getattr(self.poly, '_mqttc', None) is not None
+
+    def stop(self):
+        if self._file is None:
+            return
+        _restore(self.poly, '_message', self._hooked[0])
+        _restore(self.poly, 'send', self._hooked[1])
+        _restore(self.poly, 'sendEncoded', self._hooked[2])
+        if self._ownsTransport():
+            self.poly._mqttc.on_message = self.poly._message
+        with self._lock:
+            self._file.close()
+            self._file = None
+        LOGGER.info('Recorded {} MQTT messages to {}'.format(self.count, self.filename))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _write(self, direction, topic, payload):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps([round(time.time() - self._start, 6), direction, topic, payload],
+                separators=(',', ':')) + '\n')
+            self.count += 1
+
+    def _recordMessage(self, mqttc, userdata, msg):
+        payload = msg.payload.decode('utf-8') if isinstance(msg.payload, bytes) else msg.payload
+        self._write('in', msg.topic, payload)
+        return self._message(mqttc, userdata, msg)
+
+    def _recordSend(self, message):
+        result = self._send(message)
+        try:
+            self._write('out', self.poly.topicInput, json.dumps(message))
+        except TypeError as err:
+            LOGGER.error('Recorder: unable to encode message: {}'.format(err))
+        return result
+
+    def _recordSendEncoded(self, payload):
+        result = self._sendEncoded(payload)
+        self._write('out', self.poly.topicInput, payload)
+        return result
+
+
+class Replayer(object):
+    """
+    Feed a recording back into an Interface.
+
+    :param poly: The Interface (with its Controller attached) to drive
+    :param filename: A file written by Recorder
+    :param speed: 1.0 for original speed, 2.0 for twice as fast, 0 for as fast as possible
+    :param wait: Wait for the event and input queues to be handled before timing the next message
+    """
+    def __init__(self, poly, filename, speed=1.0, wait=True):
+        self.poly = poly
+        self.filename = filename
+        self.speed = speed
+        self.wait = wait
+        self.records = []
+        with _open(filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    self.records.append(json.loads(line))
+        self.sent = []
+
+    def _capture(self, send):
+        def capture(message):
+            result = send(message)
+            self.sent.append(json.dumps(message, sort_keys=True))
+            return result
+        return capture
+
+    def _captureEncoded(self, sendEncoded):
+        def capture(payload):
+            result = sendEncoded(payload)
+            self.sent.append(self._canonical(payload))
+            return result
+        return capture
+
+    @staticmethod
+    def _canonical(payload):
+        try:
+            return json.dumps(json.loads(payload), sort_keys=True)
+        except ValueError:
+            return payload
+
+    def run(self, settle=1.0):
+        """
+        Replay all inbound messages and return a report dict with the number
+        of messages, handler latency statistics in seconds and the outbound
+        messages that were missing or unexpected compared to the recording.
+
+        :param settle: Seconds to wait after the last message for outbound traffic
+        """
+        inbound = [r for r in self.records if r[1] == 'in']
+        LOGGER.info('Replaying {} messages from {} at speed {}'.format(len(inbound), self.filename, self.speed or 'max'))
+        del self.sent[:]
+        previous = (self.poly.__dict__.get('send'), self.poly.__dict__.get('sendEncoded'))
+        self.poly.send = self._capture(self.poly.send)
+        self.poly.sendEncoded = self._captureEncoded(self.poly.sendEncoded)
+        latencies = []
+        try:
+            start = time.time()
+            for offset, _, topic, payload in inbound:
+                if self.speed:
+                    delay = offset / self.speed - (time.time() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                began = time.time()
+                self.poly._message(None, None, RecordedMessage(topic, payload.encode('utf-8')))
+                if self.wait:
+                    self.poly.eventQueue.join()
+                    self.poly.inQueue.join()
+                latencies.append(time.time() - began)
+            time.sleep(settle)
+        finally:
+            _restore(self.poly, 'send', previous[0])
+            _restore(self.poly, 'sendEncoded', previous[1])
+        expected = Counter(self._canonical(r[3]) for r in self.records if r[1] == 'out')
+        produced = Counter(self.sent)
+        report = {
+            'messages': len(inbound),
+            'latency': {
+                'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies) if latencies else 0.0,
+            },
+            'sent': len(self.sent),
+            'missing': list((expected - produced).elements()),
+            'unexpected': list((produced - expected).elements()),
+        }
+        LOGGER.info('Replay done: {} messages, p50 {:.6f}s p99 {:.6f}s, {} missing, {} unexpected'.format(
+            report['messages'], report['latency']['p50'], report['latency']['p99'],
+            len(report['missing']), len(report['unexpected'])))
+        return report
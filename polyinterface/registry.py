@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Containers for the nodes of a Controller that are safe to read from any thread.
+
+Controller.nodes and Controller._nodes are NodeRegistry objects. Every change
+builds a new dict and swaps it in under a lock, so readers always see a
+complete dict that is never modified: iterating pollers, query handlers and
+NodeServer threads don't take a lock, don't block writers and never get
+"dictionary changed size during iteration". A change costs a copy of the
+dict, so add many entries at once with update().
+
+Controller.nodesAdding is a PendingNodes, it keeps the list API but checks
+membership in constant time.
+"""
+
+from collections import deque
+from threading import Lock
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+_MISSING = object()
+
+
+class NodeRegistry(MutableMapping):
+    """ Copy-on-write dict of address to node """
+    def __init__(self, *args, **kwargs):
+        self._lock = Lock()
+        self._data = dict(*args, **kwargs)
+
+    def snapshot(self):
+        """ The current dict, never modified afterwards so it can be kept and iterated freely """
+        return self._data
+
+    def __getitem__(self, address):
+        return self._data[address]
+
+    def get(self, address, default=None):
+        return self._data.get(address, default)
+
+    def __contains__(self, address):
+        return address in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def copy(self):
+        return dict(self._data)
+
+    def __setitem__(self, address, node):
+        with self._lock:
+            data = dict(self._data)
+            data[address] = node
+            self._data = data
+
+    def __delitem__(self, address):
+        with self._lock:
+            data = dict(self._data)
+            del data[address]
+            self._data = data
+
+    def pop(self, address, default=_MISSING):
+        with self._lock:
+            if address not in self._data:
+                if default is _MISSING:
+                    raise KeyError(address)
+                return default
+            data = dict(self._data)
+            node = data.pop(address)
+            self._data = data
+            return node
+
+    def setdefault(self, address, node=None):
+        with self._lock:
+            if address in self._data:
+                return self._data[address]
+            data = dict(self._data)
+            data[address] = node
+            self._data = data
+            return node
+
+    def update(self, *args, **kwargs):
+        """ Add or replace many entries with a single copy """
+        with self._lock:
+            data = dict(self._data)
+            data.update(*args, **kwargs)
+            self._data = data
+
+    def clear(self):
+        with self._lock:
+            self._data = {}
+
+    def __eq__(self, other):
+        if isinstance(other, NodeRegistry):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'NodeRegistry({!r})'.format(self._data)
+
+
+class PendingNodes(object):
+    """
+    Addresses of nodes waiting for Polyglot to confirm they were added.
+    Behaves like the list it replaces, in arrival order with duplicates
+    included, but in and remove take constant time.
+
+    remove doesn't search the order deque, it counts the earliest entry of
+    the address as skipped. Skipped entries are dropped when they reach the
+    front, or all at once when they outnumber the pending ones.
+    """
+    def __init__(self, addresses=()):
+        self._lock = Lock()
+        self._counts = {}
+        self._order = deque()
+        self._skip = {}
+        self._len = 0
+        self.extend(addresses)
+
+    def append(self, address):
+        with self._lock:
+            self._counts[address] = self._counts.get(address, 0) + 1
+            self._order.append(address)
+            self._len += 1
+
+    def extend(self, addresses):
+        for address in addresses:
+            self.append(address)
+
+    def remove(self, address):
+        with self._lock:
+            count = self._counts.get(address)
+            if count is None:
+                raise ValueError('{} not in nodesAdding'.format(address))
+            if count == 1:
+                del self._counts[address]
+            else:
+                self._counts[address] = count - 1
+            self._skip[address] = self._skip.get(address, 0) + 1
+            self._len -= 1
+            self._compact()
+
+    def _compact(self):
+        """ Drop skipped entries, caller holds the lock """
+        order, skip = self._order, self._skip
+        while order and skip.get(order[0]):
+            address = order.popleft()
+            if skip[address] == 1:
+                del skip[address]
+            else:
+                skip[address] -= 1
+        if len(order) > 2 * self._len + 16:
+            self._order = deque(self._pending())
+            self._skip = {}
+
+    def _pending(self):
+        """ The addresses in order without the skipped entries, caller holds the lock """
+        skip = dict(self._skip)
+        result = []
+        for address in self._order:
+            if skip.get(address):
+                skip[address] -= 1
+            else:
+                result.append(address)
+        return result
+
+    def discard(self, address):
+        """ remove that does nothing when address is not pending """
+        try:
+            self.remove(address)
+        except ValueError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._counts = {}
+            self._order = deque()
+            self._skip = {}
+            self._len = 0
+
+    def count(self, address):
+        return self._counts.get(address, 0)
+
+    def __contains__(self, address):
+        return address in self._counts
+
+    def __len__(self):
+        return self._len
+
+    def _list(self):
+        with self._lock:
+            return self._pending()
+
+    def __iter__(self):
+        return iter(self._list())
+
+    def __getitem__(self, index):
+        return self._list()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, PendingNodes):
+            other = other._list()
+        return self._list() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._list())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+Run nodes in worker processes so CPU heavy NodeServers are not limited to
+one core by the GIL.
+
+The parent process keeps the single Interface and a ShardedNode stand in
+for every node. Commands, queries, starts and polls for a node are routed
+to the worker process (shard) that owns its address, which runs the real
+Node. Anything the node sends to Polyglot is batched per request and
+forwarded back to the parent over a pipe, which publishes it.
+
+Enable it with the Controller.shards class attribute and add nodes with
+Controller.addShardedNode. Nodes in a shard get a minimal controller with
+poly, nodes and address, not the NodeServer's Controller.
+
+Workers are started with forkserver, or spawn where it is not available,
+because the pool is created once the Interface's threads are running and a
+fork would copy their locks in whatever state they are in. Node classes are
+passed to the workers by name, so they must be importable from a module or
+the NodeServer's main script.
+"""
+
+import multiprocessing
+import time
+import zlib
+from copy import deepcopy
+from threading import Lock, Thread
+from .polylogger import LOGGER
+
+
+class _ShardPoly(object):
+    """ Collects what shard nodes send and forwards it to the parent in batches """
+    def __init__(self, conn):
+        self.conn = conn
+        self.config = {'nodes': []}
+        self._pending = []
+
+    def send(self, message):
+        self._pending.append(message)
+
+    def addNode(self, node):
+        LOGGER.error('Nodes running in a shard can not add nodes: {}'.format(node.address))
+
+    def flush(self):
+        if self._pending:
+            self.conn.send(self._pending)
+            self._pending = []
+
+
+class _ShardController(object):
+    """ What a node in a shard sees as self.controller """
+    def __init__(self, poly):
+        self.poly = poly
+        self.address = 'controller'
+        self.name = 'Controller'
+        self.nodes = {}
+
+    def addNode(self, node, update=False):
+        self.poly.addNode(node)
+
+
+def _shardMain(conn, index):
+    """ Worker process main loop """
+    poly = _ShardPoly(conn)
+    controller = _ShardController(poly)
+    nodes = controller.nodes
+    LOGGER.info('Shard {} started'.format(index))
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        op = request[0]
+        try:
+            if op == 'add':
+                cls, primary, address, name, args, kwargs = request[1:]
+                nodes[address] = cls(controller, primary, address, name, *args, **kwargs)
+            elif op == 'config':
+                for config in request[1]:
+                    node = nodes.get(config['address'])
+                    if node is None:
+                        continue
+                    poly.config['nodes'] = [n for n in poly.config['nodes'] if n['address'] != config['address']]
+                    poly.config['nodes'].append(config)
+                    node.updateDrivers(config['drivers'])
+                    node.config = config
+                    node.isPrimary = config.get('isprimary')
+                    node.timeAdded = config.get('timeAdded')
+                    node.enabled = config.get('enabled')
+                    node.added = config.get('added')
+            elif op == 'command':
+                nodes[request[1]].runCmd(request[2])
+            elif op == 'setDriver':
+                nodes[request[1]].setDriver(*request[2], **request[3])
+            elif op in ('query', 'status', 'start', 'reportDrivers'):
+                getattr(nodes[request[1]], op)()
+            elif op in ('shortPoll', 'longPoll'):
+                for node in nodes.values():
+                    poll = getattr(node, op, None)
+                    if poll is not None:
+                        poll()
+            elif op == 'remove':
+                nodes.pop(request[1], None)
+            elif op == 'stop':
+                for node in nodes.values():
+                    stop = getattr(node, 'stop', None)
+                    if stop is not None:
+                        stop()
+                poly.flush()
+                break
+        except Exception as err:
+            LOGGER.error('Shard {}: {} failed: {}'.format(index, op, err), exc_info=True)
+        poly.flush()
+    LOGGER.info('Shard {} stopped'.format(index))
+
+
+def _defaultStartMethod():
+    methods = multiprocessing.get_all_start_methods()
+    return 'forkserver' if 'forkserver' in methods else 'spawn'
+
+
+class ShardPool(object):
+    """
+    The worker processes and the pipes to them.
+
+    :param poly: The Interface status reports are published through
+    :param count: Number of worker processes
+    :param startMethod: multiprocessing start method, None for forkserver or spawn where
+        forkserver is not available. fork is only safe before any thread is started.
+    """
+    def __init__(self, poly, count, startMethod=None):
+        self.poly = poly
+        self.count = count
+        self._context = multiprocessing.get_context(startMethod or _defaultStartMethod())
+        self._shards = []
+
+    def start(self):
+        for index in range(self.count):
+            parent, child = self._context.Pipe()
+            process = self._context.Process(target=_shardMain, args=(child, index), name='Shard{}'.format(index))
+            process.daemon = True
+            process.start()
+            child.close()
+            reader = Thread(target=self._reader, args=(parent, index), name='Shard{}'.format(index))
+            reader.daemon = True
+            reader.start()
+            self._shards.append((process, parent, Lock()))
+        LOGGER.info('Started {} node shards'.format(self.count))
+        return self
+
+    def shardFor(self, address):
+        """ Index of the shard that owns address, stable across processes and restarts """
+        return zlib.crc32(address.encode('utf-8')) % self.count
+
+    def _send(self, index, request):
+        _, conn, lock = self._shards[index]
+        with lock:
+            conn.send(request)
+
+    def send(self, address, request):
+        self._send(self.shardFor(address), request)
+
+    def broadcast(self, request):
+        for index in range(len(self._shards)):
+            self._send(index, request)
+
+    def add(self, cls, primary, address, name, args, kwargs):
+        self.send(address, ('add', cls, primary, address, name, args, kwargs))
+
+    def config(self, nodes):
+        """ Forward Polyglot's node config to the owning shards """
+        byShard = {}
+        for node in nodes:
+            byShard.setdefault(self.shardFor(node['address']), []).append(node)
+        for index, shardNodes in byShard.items():
+            self._send(index, ('config', shardNodes))
+
+    def _reader(self, conn, index):
+        while True:
+            try:
+                batch = conn.recv()
+            except (EOFError, OSError):
+                break
+            for message in batch:
+                self.poly.send(message)
+
+    def stop(self, timeout=None):
+        """
+        Ask every shard to stop and wait for them together, terminating those
+        still running after timeout seconds.
+
+        :param timeout: Seconds for all shards, defaults to what is left of
+            poly.shutdownDeadline, or 3 outside of a shutdown
+        """
+        if not self._shards:
+            return
+        if timeout is None:
+            deadline = getattr(self.poly, 'shutdownDeadline', None)
+            timeout = 3 if deadline is None else max(0, deadline - time.time())
+        deadline = time.time() + timeout
+        LOGGER.info('Stopping {} node shards'.format(len(self._shards)))
+        try:
+            self.broadcast(('stop',))
+        except (OSError, ValueError) as err:
+            LOGGER.error('ShardPool stop: {}'.format(err))
+        # The shards stop in parallel, so they share one deadline
+        for process, conn, _ in self._shards:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                LOGGER.warning('Shard {} did not stop in time, terminating it'.format(process.name))
+                process.terminate()
+            conn.close()
+        self._shards = []
+
+
+class ShardedNode(object):
+    """
+    Stand in for a node running in a shard. Holds what Polyglot needs to add
+    the node and forwards everything else to the owning shard.
+    """
+    def __init__(self, controller, pool, cls, primary, address, name):
+        self.controller = controller
+        self.parent = controller
+        self.pool = pool
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.id = cls.id
+        self.hint = cls.hint
+        self.drivers = deepcopy(cls.drivers)
+        self._drivers = deepcopy(cls.drivers)
+        self.compact = False
+        self.polyConfig = None
+        self.isPrimary = None
+        self.config = None
+        self.timeAdded = None
+        self.enabled = None
+        self.added = None
+
+    def runCmd(self, command):
+        self.pool.send(self.address, ('command', self.address, command))
+
+    def setDriver(self, *args, **kwargs):
+        self.pool.send(self.address, ('setDriver', self.address, args, kwargs))
+
+    def updateDrivers(self, drivers):
+        self._drivers = deepcopy(drivers)
+
+    def query(self):
+        self.pool.send(self.address, ('query', self.address))
+
+    def status(self):
+        self.pool.send(self.address, ('status', self.address))
+
+    def reportDrivers(self):
+        self.pool.send(self.address, ('reportDrivers', self.address))
+
+    def start(self):
+        self.pool.send(self.address, ('start', self.address))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Latency tracing of inbound messages from Polyglot.
+
+When Interface.tracer is set, every message queued for the input thread is
+timestamped when Interface._message receives it and when _parseInput takes
+it off inQueue. While the input thread handles it, every send or
+sendEncoded it makes is timed and counted against it, so a command can be
+followed through to the status messages it causes. Stages, in seconds:
+
+    queue     received until dispatched by the input thread
+    handler   dispatched until the handler (runCmd, shortPoll, ...) returned
+    publish   time spent in send and sendEncoded while handling
+    status    received until the first publish, command to status latency
+    total     received until the handler returned
+
+Set POLY_TRACE=<file> (or POLY_TRACE=1 for summaries only) to trace from
+start up, or call Interface.startTracing. Finished traces are written to the
+file as JSON lines. Commands run on a node's command thread, see
+polyinterface.coalesce, don't have their publishes counted.
+"""
+
+import json
+import time
+from collections import deque
+from threading import Lock, local
+from .polylogger import LOGGER
+from .recorder import _open, percentile
+
+STAGES = ('queue', 'handler', 'publish', 'status', 'total')
+
+
+class Trace(object):
+    __slots__ = ('key', 'address', 'cmd', 'received', 'dispatched', 'finished',
+        'firstPublish', 'publishTime', 'publishes')
+
+    def __init__(self, message, received):
+        self.key = next(iter(message), None)
+        body = message.get(self.key)
+        self.address = body.get('address') if isinstance(body, dict) else None
+        self.cmd = body.get('cmd') if isinstance(body, dict) else None
+        self.received = received
+        self.dispatched = None
+        self.finished = None
+        self.firstPublish = None
+        self.publishTime = 0.0
+        self.publishes = 0
+
+    def stages(self):
+        return {
+            'queue': self.dispatched - self.received,
+            'handler': self.finished - self.dispatched,
+            'publish': self.publishTime,
+            'status': None if self.firstPublish is None else self.firstPublish - self.received,
+            'total': self.finished - self.received,
+        }
+
+
+class Tracer(object):
+    """
+    :param filename: JSON lines file finished traces are written to, gzip compressed when it ends in .gz
+    :param maxTraces: Number of finished traces kept for summary
+    """
+    def __init__(self, filename=None, maxTraces=10000):
+        self.filename = filename
+        self.traces = deque(maxlen=maxTraces)
+        self._pending = {}
+        self._current = local()
+        self._lock = Lock()
+        self._file = _open(filename, 'w') if filename else None
+        if filename:
+            LOGGER.info('Tracing input latency to {}'.format(filename))
+
+    def received(self, message, at=None):
+        """ Called before message is put on inQueue """
+        with self._lock:
+            self._pending[id(message)] = Trace(message, time.time() if at is None else at)
+
+    def dispatched(self, message):
+        """ Called by the input thread when it takes message off inQueue """
+        with self._lock:
+            trace = self._pending.pop(id(message), None)
+        if trace is not None:
+            trace.dispatched = time.time()
+        self._current.trace = trace
+
+    def published(self, started):
+        """ Called after a publish that began at started, counted against the message being handled """
+        trace = getattr(self._current, 'trace', None)
+        if trace is None:
+            return
+        now = time.time()
+        if trace.firstPublish is None:
+            trace.firstPublish = now
+        trace.publishTime += now - started
+        trace.publishes += 1
+
+    def finished(self, message):
+        """ Called by the input thread when it is done with message """
+        trace = getattr(self._current, 'trace', None)
+        self._current.trace = None
+        if trace is None:
+            return
+        trace.finished = time.time()
+        self.traces.append(trace)
+        if self._file is not None:
+            record = dict((stage, None if value is None else round(value, 6)) for stage, value in trace.stages().items())
+            record.update(at=round(trace.received, 6), key=trace.key, address=trace.address, cmd=trace.cmd,
+                publishes=trace.publishes)
+            with self._lock:
+                if self._file is not None:
+                    self._file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def summary(self, key=None):
+        """
+        Dict of stage to count, mean, p50, p90, p99 and max in seconds over the
+        kept traces, only those of key (e.g. 'command') when given.
+        """
+        traces = [t for t in list(self.traces) if key is None or t.key == key]
+        values = dict((stage, []) for stage in STAGES)
+        for trace in traces:
+            for stage, value in trace.stages().items():
+                if value is not None:
+                    values[stage].append(value)
+        result = {}
+        for stage in STAGES:
+            data = values[stage]
+            result[stage] = {
+                'count': len(data),
+                'mean': sum(data) / len(data) if data else 0.0,
+                'p50': percentile(data, 50),
+                'p90': percentile(data, 90),
+                'p99': percentile(data, 99),
+                'max': max(data) if data else 0.0,
+            }
+        return result
+
+    def logSummary(self, key=None):
+        for stage, stats in self.summary(key).items():
+            if stats['count']:
+                LOGGER.info('Trace {}{}: {} samples, p50 {:.2f}ms p90 {:.2f}ms p99 {:.2f}ms max {:.2f}ms'.format(
+                    stage, '' if key is None else ' ({})'.format(key), stats['count'], stats['p50'] * 1000,
+                    stats['p90'] * 1000, stats['p99'] * 1000, stats['max'] * 1000))
+
+    def stop(self):
+        self.logSummary()
+        with self._lock:
+            self._pending.clear()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
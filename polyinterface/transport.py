@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+"""
+Transports used by Interface to talk to Polyglot.
+
+Every transport follows the subset of the paho.mqtt.client.Client API that
+Interface uses: connect_async, loop_forever, loop_stop, subscribe, publish,
+reconnect, disconnect and the on_connect, on_message, on_subscribe,
+on_disconnect, on_publish and on_log callbacks, called with the same
+arguments paho uses.
+
+MqttTransport is the default, paho over TCP with optional TLS.
+MemoryTransport connects to an in process MemoryBroker for tests and
+benchmarks. UnixSocketTransport is paho MQTT over a Unix domain socket
+instead of TCP and TLS, for NodeServers running on the same host as a broker
+with a Unix socket listener (mosquitto's `listener 0 <path>`, or
+UnixSocketBroker).
+
+MqttBroker is a minimal MQTT 3.1.1 broker on localhost for MqttTransport,
+used by scripts/loadtest.py to test the real connection code without
+Polyglot. UnixSocketBroker is the same broker on a Unix domain socket.
+"""
+
+import os
+import socket
+import ssl
+import struct
+from abc import ABCMeta, abstractmethod
+from os.path import join, expanduser
+from threading import Lock, RLock, Thread
+import paho.mqtt.client as mqtt
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from .polylogger import LOGGER
+
+
+# abc.ABC, which Python 2 doesn't have
+_ABC = ABCMeta('ABC', (object,), {'__slots__': ()})
+
+
+class Transport(_ABC):
+    """
+    Base class for the non paho transports. Subclasses implement _connect,
+    _subscribe, _send and _close and call _deliver for every message received.
+    """
+    def __init__(self):
+        self.on_connect = None
+        self.on_message = None
+        self.on_subscribe = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_log = None
+        self._inbox = queue.Queue()
+        self._mid = 0
+        self._lock = Lock()
+        self._looping = False
+        self.connected = False
+
+    def _nextMid(self):
+        with self._lock:
+            self._mid += 1
+            return self._mid
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        self._host = host
+        self._port = port
+
+    def loop_forever(self, *args, **kwargs):
+        """ Connect and run callbacks on the calling thread until disconnect """
+        self._looping = True
+        self._connect()
+        self.connected = True
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        while True:
+            msg = self._inbox.get()
+            if msg is None:
+                break
+            if self.on_message:
+                self.on_message(self, None, msg)
+
+    def loop_stop(self, force=False):
+        self._wake()
+
+    def _wake(self):
+        if self._looping:
+            self._looping = False
+            self._inbox.put(None)
+
+    def subscribe(self, topic, qos=0):
+        mid = self._nextMid()
+        self._subscribe(topic)
+        if self.on_subscribe:
+            self.on_subscribe(self, None, mid, (qos,))
+        return (mqtt.MQTT_ERR_SUCCESS, mid)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if payload is not None and not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        info = MessageInfo(self._nextMid())
+        self._send(topic, payload or b'', retain)
+        if self.on_publish:
+            self.on_publish(self, None, info.mid)
+        return info
+
+    def reconnect(self):
+        self._close()
+        self._connect()
+        self.connected = True
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+
+    def disconnect(self):
+        if not self.connected:
+            return
+        self.connected = False
+        self._close()
+        self._wake()
+        if self.on_disconnect:
+            self.on_disconnect(self, None, 0)
+
+    def _deliver(self, topic, payload, retain=False):
+        msg = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+        msg.payload = payload
+        msg.retain = retain
+        self._inbox.put(msg)
+
+    @abstractmethod
+    def _connect(self):
+        pass
+
+    @abstractmethod
+    def _subscribe(self, topic):
+        pass
+
+    @abstractmethod
+    def _send(self, topic, payload, retain):
+        pass
+
+    @abstractmethod
+    def _close(self):
+        pass
+
+
+class MessageInfo(object):
+    """ Same shape as paho's MQTTMessageInfo for transports that publish synchronously """
+    def __init__(self, mid, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+
+    def is_published(self):
+        return True
+
+    def wait_for_publish(self, timeout=None):
+        return True
+
+
+class MqttTransport(mqtt.Client):
+    """
+    The default transport, paho MQTT over TCP. TLS is set up from
+    MQTT_CERTPATH or ~/.polyglot/ssl when useSecure is True.
+    """
+    def __init__(self, client_id=None, clean_session=True, useSecure=True):
+        mqtt.Client.__init__(self, client_id, clean_session)
+        self._writeLock = RLock()
+        if useSecure:
+            if 'MQTT_CERTPATH' in os.environ:
+                self.tls_set(
+                    ca_certs=os.environ['MQTT_CERTPATH'] + '/polyglot.crt',
+                    certfile=os.environ['MQTT_CERTPATH'] + '/client.crt',
+                    keyfile=os.environ['MQTT_CERTPATH'] + '/client_private.key',
+                    tls_version=ssl.PROTOCOL_TLSv1_2)
+            else:
+                self.tls_set(
+                    ca_certs=join(expanduser("~") + '/.polyglot/ssl/polyglot.crt'),
+                    certfile=join(expanduser("~") + '/.polyglot/ssl/client.crt'),
+                    keyfile=join(expanduser("~") + '/.polyglot/ssl/client_private.key'),
+                    tls_version=ssl.PROTOCOL_TLSv1_2
+                    )
+
+    def loop_write(self, max_packets=1):
+        """
+        With loop_forever paho writes a publish on the thread calling publish,
+        so the input, Events, Status and NodeServer threads and the network
+        loop can write to the socket at the same time, which corrupts TLS.
+        """
+        with self._writeLock:
+            return mqtt.Client.loop_write(self, max_packets)
+
+
+class UnixSocketTransport(MqttTransport):
+    """
+    paho MQTT over a Unix domain socket, bypassing TCP and TLS when the
+    NodeServer and broker share a host. The host and port given to
+    connect_async are ignored.
+
+    :param path: Path of the broker socket
+    :param client_id: MQTT client id
+    """
+    def __init__(self, path, client_id=None, clean_session=True):
+        MqttTransport.__init__(self, client_id, clean_session, useSecure=False)
+        self.path = path
+
+    def _create_socket_connection(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._connect_timeout)
+        try:
+            sock.connect(self.path)
+        except (OSError, socket.error):
+            sock.close()
+            raise
+        return sock
+
+
+class _Router(object):
+    """ Topic routing and retained messages shared by the brokers """
+    def __init__(self):
+        self._subscriptions = {}
+        self._retained = {}
+        self._lock = Lock()
+
+    def subscribe(self, client, topic):
+        with self._lock:
+            self._subscriptions.setdefault(topic, set()).add(client)
+            retained = [(t, p) for t, p in self._retained.items() if mqtt.topic_matches_sub(topic, t)]
+        for t, p in retained:
+            client._deliver(t, p, True)
+
+    def unsubscribe(self, client, topic):
+        with self._lock:
+            self._subscriptions.get(topic, set()).discard(client)
+
+    def unsubscribeAll(self, client):
+        with self._lock:
+            for clients in self._subscriptions.values():
+                clients.discard(client)
+
+    def publish(self, topic, payload, retain=False):
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained[topic] = payload
+                else:
+                    self._retained.pop(topic, None)
+            targets = set()
+            for sub, clients in self._subscriptions.items():
+                if clients and mqtt.topic_matches_sub(sub, topic):
+                    targets.update(clients)
+        for client in targets:
+            client._deliver(topic, payload)
+
+
+class MemoryBroker(_Router):
+    """
+    In process broker for MemoryTransport. Messages are queued to each
+    subscriber and handled on the thread running its loop_forever.
+    """
+    pass
+
+
+class MemoryTransport(Transport):
+    """
+    Transport connected to a MemoryBroker in the same process.
+
+    :param broker: The MemoryBroker to connect to
+    """
+    def __init__(self, broker):
+        Transport.__init__(self)
+        self.broker = broker
+
+    def _connect(self):
+        pass
+
+    def _subscribe(self, topic):
+        self.broker.subscribe(self, topic)
+
+    def _send(self, topic, payload, retain):
+        self.broker.publish(topic, payload, retain)
+
+    def _close(self):
+        self.broker.unsubscribeAll(self)
+
+
+"""
+MQTT 3.1.1 packets handled by MqttBroker: CONNECT, PUBLISH at qos 0 and 1
+(acknowledged with PUBACK), SUBSCRIBE, UNSUBSCRIBE, PINGREQ and DISCONNECT.
+Messages are delivered to subscribers at qos 0. Wills, sessions and qos 2
+are not supported.
+"""
+_CONNECT, _CONNACK, _PUBLISH, _PUBACK = 1, 2, 3, 4
+_SUBSCRIBE, _SUBACK, _UNSUBSCRIBE, _UNSUBACK = 8, 9, 10, 11
+_PINGREQ, _PINGRESP, _DISCONNECT = 12, 13, 14
+
+
+def _readExact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _mqttPacket(packetType, flags, body=b''):
+    length = len(body)
+    header = bytearray([packetType << 4 | flags])
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+def _readMqttPacket(sock):
+    first = _readExact(sock, 1)
+    if first is None:
+        return None
+    length, multiplier = 0, 1
+    while True:
+        byte = _readExact(sock, 1)
+        if byte is None:
+            return None
+        length += (ord(byte) & 0x7f) * multiplier
+        if not ord(byte) & 0x80:
+            break
+        multiplier *= 128
+    body = _readExact(sock, length) if length else b''
+    if body is None:
+        return None
+    return ord(first) >> 4, ord(first) & 0x0f, body
+
+
+def _mqttString(data, offset):
+    """ (string, next offset) of the length prefixed UTF-8 string at offset """
+    size = struct.unpack('>H', data[offset:offset + 2])[0]
+    return data[offset + 2:offset + 2 + size].decode('utf-8'), offset + 2 + size
+
+
+class _MqttClient(object):
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.lock = Lock()
+        self.clientId = None
+
+    def _write(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def _deliver(self, topic, payload, retain=False):
+        topic = topic.encode('utf-8')
+        try:
+            self._write(_mqttPacket(_PUBLISH, 1 if retain else 0, struct.pack('>H', len(topic)) + topic + payload))
+        except (OSError, socket.error):
+            self.broker.unsubscribeAll(self)
+
+
+class MqttBroker(_Router):
+    """
+    Minimal MQTT broker on a local TCP port, with TLS when certfile is given.
+
+    :param host: Address to listen on
+    :param port: Port to listen on, 0 picks a free one, see self.port after start
+    :param certfile: Server certificate for TLS
+    :param keyfile: Private key of certfile
+    :param cafile: CA that client certificates must be signed by, required when given
+    """
+    def __init__(self, host='127.0.0.1', port=0, certfile=None, keyfile=None, cafile=None):
+        _Router.__init__(self)
+        self.host = host
+        self.port = port
+        self.context = None
+        if certfile:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(certfile, keyfile)
+            if cafile:
+                self.context.load_verify_locations(cafile)
+                self.context.verify_mode = ssl.CERT_REQUIRED
+        self.stats = {'connects': 0, 'received': 0, 'dropped': 0}
+        self._server = None
+        self._clients = set()
+
+    def start(self):
+        self._server = self._listen()
+        thread = Thread(target=self._accept, name='MqttBroker')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _listen(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen(16)
+        self.port = server.getsockname()[1]
+        LOGGER.info('MqttBroker listening on {}:{}{}'.format(self.host, self.port, ' with TLS' if self.context else ''))
+        return server
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        self.dropClients()
+
+    def dropClients(self, exclude=()):
+        """
+        Close the connection of every client, except those whose client id is
+        in exclude, without a DISCONNECT so they see a network failure.
+        Returns the number of clients dropped.
+        """
+        with self._lock:
+            clients = [c for c in self._clients if c.clientId not in exclude]
+        for client in clients:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+        self.stats['dropped'] += len(clients)
+        return len(clients)
+
+    def _accept(self):
+        while self._server is not None:
+            try:
+                sock, _ = self._server.accept()
+            except (OSError, socket.error):
+                break
+            thread = Thread(target=self._serve, args=(sock,), name='MqttBroker')
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, sock):
+        if self.context is not None:
+            try:
+                sock = self.context.wrap_socket(sock, server_side=True)
+            except (ssl.SSLError, OSError) as err:
+                LOGGER.error('MqttBroker: TLS handshake failed: {}'.format(err))
+                sock.close()
+                return
+        client = _MqttClient(self, sock)
+        with self._lock:
+            self._clients.add(client)
+        try:
+            while True:
+                try:
+                    packet = _readMqttPacket(sock)
+                except (OSError, socket.error):
+                    packet = None
+                if packet is None or packet[0] == _DISCONNECT:
+                    break
+                self._handle(client, *packet)
+        except (OSError, socket.error):
+            pass
+        finally:
+            self.unsubscribeAll(client)
+            with self._lock:
+                self._clients.discard(client)
+            sock.close()
+
+    def _handle(self, client, packetType, flags, body):
+        if packetType == _CONNECT:
+            # Protocol name, level, flags and keep alive come before the client id
+            _, offset = _mqttString(body, 0)
+            client.clientId, _ = _mqttString(body, offset + 4)
+            self.stats['connects'] += 1
+            client._write(_mqttPacket(_CONNACK, 0, b'\x00\x00'))
+        elif packetType == _PUBLISH:
+            qos = (flags >> 1) & 3
+            topic, offset = _mqttString(body, 0)
+            if qos:
+                packetId = body[offset:offset + 2]
+                offset += 2
+            self.stats['received'] += 1
+            self.publish(topic, body[offset:], bool(flags & 1))
+            if qos:
+                client._write(_mqttPacket(_PUBACK, 0, packetId))
+        elif packetType == _SUBSCRIBE:
+            packetId, offset, topics = body[:2], 2, []
+            while offset < len(body):
+                topic, offset = _mqttString(body, offset)
+                topics.append(topic)
+                offset += 1
+            client._write(_mqttPacket(_SUBACK, 0, packetId + b'\x00' * len(topics)))
+            for topic in topics:
+                self.subscribe(client, topic)
+        elif packetType == _UNSUBSCRIBE:
+            packetId, offset = body[:2], 2
+            while offset < len(body):
+                topic, offset = _mqttString(body, offset)
+                self.unsubscribe(client, topic)
+            client._write(_mqttPacket(_UNSUBACK, 0, packetId))
+        elif packetType == _PINGREQ:
+            client._write(_mqttPacket(_PINGRESP, 0))
+        else:
+            LOGGER.error('MqttBroker: unsupported packet type {} from {}'.format(packetType, client.clientId))
+
+
+class UnixSocketBroker(MqttBroker):
+    """
+    MqttBroker listening on a Unix domain socket for UnixSocketTransport clients.
+
+    :param path: Path of the socket to create
+    """
+    def __init__(self, path):
+        MqttBroker.__init__(self, host=None)
+        self.path = path
+
+    def _listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(16)
+        LOGGER.info('UnixSocketBroker listening on {}'.format(self.path))
+        return server
+
+    def stop(self):
+        MqttBroker.stop(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
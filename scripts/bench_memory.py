@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Memory benchmark for Node driver storage.
+
+Builds the same set of nodes with the default storage and with
+compact = True, applies a Polyglot style config to each, and reports
+the bytes used per node.
+
+    python scripts/bench_memory.py [count ...]
+"""
+import gc
+import sys
+import tracemalloc
+import polyinterface
+
+DRIVERS = [
+    {'driver': 'ST', 'value': 0, 'uom': 2},
+    {'driver': 'GV0', 'value': 0, 'uom': 56},
+    {'driver': 'GV1', 'value': 0, 'uom': 56},
+    {'driver': 'GV2', 'value': 0, 'uom': 56},
+    {'driver': 'CLITEMP', 'value': 0, 'uom': 17},
+    {'driver': 'CLIHUM', 'value': 0, 'uom': 22},
+    {'driver': 'BATLVL', 'value': 0, 'uom': 51},
+    {'driver': 'ERR', 'value': 0, 'uom': 25},
+]
+
+
+class LegacyNode(polyinterface.Node):
+    id = 'bench'
+    drivers = DRIVERS
+
+
+class CompactNode(polyinterface.Node):
+    id = 'bench'
+    compact = True
+    drivers = DRIVERS
+
+
+def config_drivers(index):
+    return [{'driver': d['driver'], 'value': str(index), 'uom': d['uom']} for d in DRIVERS]
+
+
+def measure(cls, count):
+    configs = [config_drivers(i) for i in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    nodes = []
+    for i in range(count):
+        node = cls(None, 'controller', 'n{}'.format(i), 'Node {}'.format(i))
+        node.updateDrivers(configs[i])
+        nodes.append(node)
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used // count
+
+
+def main(counts):
+    out = sys.__stdout__
+    out.write('{:>8} {:>14} {:>14} {:>8}\n'.format('nodes', 'legacy B/node', 'compact B/node', 'saved'))
+    for count in counts:
+        legacy = measure(LegacyNode, count)
+        compact = measure(CompactNode, count)
+        out.write('{:>8} {:>14} {:>14} {:>7.0%}\n'.format(count, legacy, compact, 1 - float(compact) / legacy))
+
+
+if __name__ == "__main__":
+    main([int(c) for c in sys.argv[1:]] or [100, 1000, 2000])
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark for the Interface and Controller hot paths.
+
+Drives Interface._message, Interface.send, Controller._parseInput,
+Node.setDriver, Node.reportDriver and Controller._gotConfig with synthetic
+Polyglot payloads through a stub transport, so no broker or certificates
+are needed.
+'Node.reportDriver dict' is reportDriver without the pre-encoded status
+templates, for comparison.
+
+    python scripts/benchmark.py [-n 10 100 1000 10000] [-o results.json] [-c previous.json]
+
+Each case reports ops/sec, p50/p99 latency in microseconds and the peak
+traced memory. Results are saved as JSON and can be compared against a
+previous run with --compare.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import polyinterface
+from polyinterface.recorder import percentile
+
+OUT = sys.__stdout__
+DRIVERS = [
+    {'driver': 'ST', 'value': 0, 'uom': 2},
+    {'driver': 'GV0', 'value': 0, 'uom': 56},
+    {'driver': 'GV1', 'value': 0, 'uom': 56},
+    {'driver': 'CLITEMP', 'value': 0, 'uom': 17},
+]
+
+
+class StubMessage(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+
+
+class StubClient(object):
+    """ Stands in for paho.mqtt.client.Client, only counts publishes """
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        pass
+
+    def loop_forever(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        return (0, 1)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class BenchNode(polyinterface.Node):
+    id = 'bench'
+    drivers = DRIVERS
+
+    def cmd_don(self, command):
+        self.controller.handled.append(time.perf_counter())
+
+    commands = {'DON': cmd_don}
+
+
+class BenchController(polyinterface.Controller):
+    def __init__(self, poly):
+        self.handled = []
+        super(BenchController, self).__init__(poly)
+
+
+def summarize(name, count, latencies, elapsed, peak):
+    return {
+        'case': name,
+        'nodes': count,
+        'ops': len(latencies),
+        'ops_per_sec': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_us': round(percentile(latencies, 50) * 1e6, 2),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 2),
+        'peak_kb': round(peak / 1024.0, 1),
+    }
+
+
+def make_config(count):
+    nodes = [{
+        'address': 'controller', 'name': 'Controller', 'node_def_id': 'controller',
+        'isprimary': True, 'timeAdded': 0, 'enabled': True, 'added': True,
+        'drivers': [{'driver': 'ST', 'value': '1', 'uom': 2}]
+    }]
+    for i in range(count):
+        nodes.append({
+            'address': 'n{}'.format(i), 'name': 'Node {}'.format(i), 'node_def_id': 'bench',
+            'isprimary': False, 'timeAdded': 0, 'enabled': True, 'added': True,
+            'drivers': [{'driver': d['driver'], 'value': str(i), 'uom': d['uom']} for d in DRIVERS]
+        })
+    return {'nodes': nodes, 'isyVersion': '5.0.16', 'customParams': {}, 'customData': {},
+            'notices': {}, 'customParamsDoc': ''}
+
+
+def setup(poly, controller, count):
+    nodes = {controller.address: controller}
+    for i in range(count):
+        node = BenchNode(controller, controller.address, 'n{}'.format(i), 'Node {}'.format(i))
+        node._buildStatusTemplates()
+        nodes[node.address] = node
+    controller.nodes = polyinterface.NodeRegistry(nodes)
+    controller._nodes = polyinterface.NodeRegistry()
+    controller.nodesAdding = polyinterface.PendingNodes()
+    poly.config = make_config(count)
+    # Warm the config path once so the controller is started
+    controller._gotConfig(poly.config)
+
+
+def case_message(poly, controller, count):
+    del controller.handled[:]
+    payloads = [StubMessage(poly.topicInput, json.dumps({
+        'node': 'polyglot', 'command': {'address': 'n{}'.format(i), 'cmd': 'DON'}}).encode('utf-8'))
+        for i in range(count)]
+    latencies = []
+    for msg in payloads:
+        start = time.perf_counter()
+        poly._message(None, None, msg)
+        latencies.append(time.perf_counter() - start)
+    poly.inQueue.join()
+    return latencies
+
+
+def case_send(poly, controller, count):
+    latencies = []
+    for i in range(count):
+        message = {'status': {'address': 'n{}'.format(i), 'driver': 'ST', 'value': str(i), 'uom': 2}}
+        start = time.perf_counter()
+        poly.send(message)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def case_parse_input(poly, controller, count):
+    """
+    From Interface.input until the command handler runs on the input thread,
+    one input at a time so no latency includes the handlers queued before it
+    """
+    del controller.handled[:]
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        poly.input({'command': {'address': 'n{}'.format(i), 'cmd': 'DON'}})
+        poly.inQueue.join()
+        latencies.append(controller.handled[-1] - start)
+    return latencies
+
+
+def case_set_driver(poly, controller, count):
+    latencies = []
+    for i, node in enumerate(list(controller.nodes.values())[1:]):
+        start = time.perf_counter()
+        node.setDriver('GV1', i + count)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def case_report_driver(poly, controller, count):
+    latencies = []
+    for node in list(controller.nodes.values())[1:]:
+        driver = node.drivers[0]
+        start = time.perf_counter()
+        node.reportDriver(driver, True, True)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def case_report_driver_dict(poly, controller, count):
+    """ reportDriver building and encoding the message dict, as before status templates """
+    for node in list(controller.nodes.values())[1:]:
+        del node._statusTemplates
+    return case_report_driver(poly, controller, count)
+
+
+def case_got_config(poly, controller, count):
+    latencies = []
+    for _ in range(5):
+        start = time.perf_counter()
+        controller._gotConfig(poly.config)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+CASES = [
+    ('Interface._message', case_message),
+    ('Interface.send', case_send),
+    ('Controller._parseInput', case_parse_input),
+    ('Node.setDriver', case_set_driver),
+    ('Node.reportDriver', case_report_driver),
+    ('Node.reportDriver dict', case_report_driver_dict),
+    ('Controller._gotConfig', case_got_config),
+]
+
+
+def run(counts):
+    poly = polyinterface.Interface('Benchmark', transport=StubClient())
+    poly.connected = True
+    controller = BenchController(poly)
+    results = []
+    for count in counts:
+        for name, case in CASES:
+            setup(poly, controller, count)
+            start = time.perf_counter()
+            latencies = case(poly, controller, count)
+            elapsed = time.perf_counter() - start
+            # Second pass for memory since tracing skews the timings
+            setup(poly, controller, count)
+            tracemalloc.start()
+            case(poly, controller, count)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result = summarize(name, count, latencies, elapsed, peak)
+            results.append(result)
+            OUT.write('{case:<24} {nodes:>6} nodes {ops_per_sec:>12} ops/s  p50 {p50_us:>9}us  p99 {p99_us:>9}us  peak {peak_kb:>9}KB\n'.format(**result))
+    return results
+
+
+def compare(results, previous):
+    old = dict(((r['case'], r['nodes']), r) for r in previous['results'])
+    OUT.write('\nCompared to {} ({}):\n'.format(previous.get('version'), previous.get('timestamp')))
+    for result in results:
+        before = old.get((result['case'], result['nodes']))
+        if before and before['ops_per_sec']:
+            change = result['ops_per_sec'] / before['ops_per_sec'] - 1
+            OUT.write('{:<24} {:>6} nodes {:>+8.1%} ops/s\n'.format(result['case'], result['nodes'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark polyinterface hot paths')
+    parser.add_argument('-n', '--nodes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('-c', '--compare', help='previous results file to compare against')
+    args = parser.parse_args()
+    os.environ.setdefault('PROFILE_NUM', '1')
+    results = run(args.nodes)
+    data = {
+        'version': polyinterface.__version__,
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(data, f, indent=2)
+    OUT.write('Saved results to {}\n'.format(args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
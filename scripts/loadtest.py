@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+End-to-end load test of a NodeServer against a local MQTT broker.
+
+Starts polyinterface.MqttBroker on localhost and a FakePolyglot peer that
+behaves like Polyglot: it answers the NodeServer's connected message with a
+config, confirms every addnode with a result, and sends commands and
+shortPolls at the given rates. The NodeServer runs the normal Interface and
+Controller over MqttTransport, so _startMqtt, _connect, subscribing and
+reconnecting are all exercised. Every command sets a driver to its sequence
+number, so the status it causes gives the command to status latency.
+
+    python scripts/loadtest.py [-n 100] [-d 20] [--commands 200] [--polls 1]
+                               [--disconnect-every 5] [--tls DIR] [-o loadtest.json]
+
+--disconnect-every drops the NodeServer's connection at the broker to measure
+how long it takes to reconnect and to handle commands again. --tls runs the
+broker with TLS and points MQTT_CERTPATH at DIR, creating a CA, server and
+client certificates there with openssl if they don't exist.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from threading import Event, Lock
+import paho.mqtt.client as mqtt
+import polyinterface
+from polyinterface import MqttBroker
+from benchmark import make_config, percentile
+
+OUT = sys.__stdout__
+PROFILE = '1'
+
+
+def makeCerts(path):
+    """ CA (polyglot.crt), server and client certificates like ~/.polyglot/ssl, made with openssl """
+    if os.path.exists(os.path.join(path, 'server.crt')):
+        return
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    def run(*args):
+        subprocess.check_call(('openssl',) + args, cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    run('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2', '-subj', '/CN=loadtest-ca',
+        '-keyout', 'ca.key', '-out', 'polyglot.crt')
+    with open(os.path.join(path, 'san.ext'), 'w') as f:
+        f.write('subjectAltName=IP:127.0.0.1,DNS:localhost\n')
+    for name, key in (('server', 'server_private.key'), ('client', 'client_private.key')):
+        run('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=localhost', '-keyout', key, '-out', name + '.csr')
+        run('x509', '-req', '-in', name + '.csr', '-CA', 'polyglot.crt', '-CAkey', 'ca.key', '-CAcreateserial',
+            '-days', '2', '-extfile', 'san.ext', '-out', name + '.crt')
+
+
+class FakePolyglot(object):
+    """
+    Stands in for Polyglot on the broker for one profile.
+
+    :param port: Broker port
+    :param count: Number of load nodes in the config
+    :param certpath: Directory with polyglot.crt, client.crt and client_private.key for TLS
+    """
+    def __init__(self, port, count, certpath=None):
+        self.count = count
+        self.topic = 'udi/polyglot/ns/{}'.format(PROFILE)
+        self.client = mqtt.Client('polyglot')
+        if certpath:
+            self.client.tls_set(ca_certs=os.path.join(certpath, 'polyglot.crt'),
+                certfile=os.path.join(certpath, 'client.crt'),
+                keyfile=os.path.join(certpath, 'client_private.key'))
+        self.client.on_connect = self._connect
+        self.client.on_subscribe = self._subscribed
+        self.client.on_message = self._message
+        self.client.connect('127.0.0.1', port, 10)
+        self.lock = Lock()
+        self.sent = {}
+        self.latencies = []
+        self.statuses = 0
+        self.commands = 0
+        self.polls = 0
+        self.added = 0
+        self.connectedAt = []
+        self.subscribed = Event()
+        self.ready = Event()
+
+    def _connect(self, client, userdata, flags, rc):
+        client.subscribe([('udi/polyglot/connections/{}'.format(PROFILE), 0), (self.topic, 0)])
+
+    def _subscribed(self, client, userdata, mid, granted_qos):
+        self.subscribed.set()
+
+    def publish(self, message):
+        message['node'] = 'polyglot'
+        self.client.publish(self.topic, json.dumps(message))
+
+    def _message(self, client, userdata, msg):
+        message = json.loads(msg.payload.decode('utf-8'))
+        if msg.topic != self.topic:
+            if message.get('connected') and not msg.retain:
+                self.connectedAt.append(time.time())
+                self.publish({'config': make_config(self.count)})
+            return
+        if message.get('node') == 'polyglot':
+            return
+        if 'addnode' in message:
+            for node in message['addnode']['nodes']:
+                self.added += 1
+                self.publish({'result': {'addnode': {'success': True, 'address': node['address']}}})
+            if self.added >= self.count:
+                self.ready.set()
+        elif 'status' in message and message['status']['driver'] == 'GV0':
+            now = time.time()
+            with self.lock:
+                self.statuses += 1
+                sent = self.sent.pop(int(message['status']['value']), None)
+                if sent is not None:
+                    self.latencies.append((sent, now - sent))
+
+    def command(self, seq):
+        with self.lock:
+            self.sent[seq] = time.time()
+            self.commands += 1
+        self.publish({'command': {'address': 'n{}'.format(seq % self.count), 'cmd': 'DON', 'value': seq}})
+
+    def shortPoll(self):
+        self.polls += 1
+        self.publish({'shortPoll': {}})
+
+
+class LoadNode(polyinterface.Node):
+    id = 'bench'
+    drivers = [
+        {'driver': 'ST', 'value': 0, 'uom': 2},
+        {'driver': 'GV0', 'value': 0, 'uom': 56},
+    ]
+
+    def cmd_don(self, command):
+        self.setDriver('GV0', command['value'])
+
+    commands = {'DON': cmd_don}
+
+
+class LoadController(polyinterface.Controller):
+    def __init__(self, poly, count):
+        self.count = count
+        self.polled = 0
+        super(LoadController, self).__init__(poly)
+
+    def start(self):
+        for i in range(self.count):
+            self.addNode(LoadNode(self, self.address, 'n{}'.format(i), 'Node {}'.format(i)))
+
+    def shortPoll(self):
+        self.polled += 1
+
+
+def run(args):
+    if args.tls:
+        makeCerts(args.tls)
+        broker = MqttBroker(certfile=os.path.join(args.tls, 'server.crt'),
+            keyfile=os.path.join(args.tls, 'server_private.key'),
+            cafile=os.path.join(args.tls, 'polyglot.crt')).start()
+        os.environ['MQTT_CERTPATH'] = args.tls
+        os.environ.pop('USE_HTTPS', None)
+    else:
+        broker = MqttBroker().start()
+        os.environ['USE_HTTPS'] = 'false'
+    os.environ['MQTT_HOST'] = '127.0.0.1'
+    os.environ['MQTT_PORT'] = str(broker.port)
+
+    peer = FakePolyglot(broker.port, args.nodes, args.tls)
+    peer.client.loop_start()
+    poly = None
+    try:
+        # Polyglot is listening before the NodeServer connects
+        if not peer.subscribed.wait(10):
+            OUT.write('FakePolyglot could not subscribe\n')
+            return None
+        poly = polyinterface.Interface('LoadTest')
+        controller = LoadController(poly, args.nodes)
+        poly.start()
+        if not peer.ready.wait(30):
+            OUT.write('NodeServer did not add its nodes, {} of {} added\n'.format(peer.added, args.nodes))
+            return None
+        return measure(args, broker, peer, controller)
+    finally:
+        if poly is not None:
+            poly.stop()
+        peer.client.loop_stop()
+        broker.stop()
+
+
+def measure(args, broker, peer, controller):
+    """ Send commands and polls for args.duration seconds and return the results """
+    drops = []
+    start = time.time()
+    # Values below the node count could match what the config already reported
+    first = seq = args.nodes
+    nextPoll = start
+    nextDrop = start + args.disconnect_every if args.disconnect_every else None
+    interval = 1.0 / args.commands
+    while time.time() - start < args.duration:
+        now = time.time()
+        if nextDrop is not None and now >= nextDrop:
+            drops.append(now)
+            broker.dropClients(exclude=('polyglot',))
+            nextDrop = now + args.disconnect_every
+        if args.polls and now >= nextPoll:
+            peer.shortPoll()
+            nextPoll = now + 1.0 / args.polls
+        peer.command(seq)
+        seq += 1
+        delay = start + (seq - first) * interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    elapsed = time.time() - start
+    # Let the last commands' statuses arrive, not counted in the throughput
+    time.sleep(1)
+
+    latencies = [latency for _, latency in peer.latencies]
+    recoveries = []
+    for dropped in drops:
+        reconnect = next((at - dropped for at in peer.connectedAt if at >= dropped), None)
+        handled = next((sent + latency - dropped for sent, latency in peer.latencies if sent >= dropped), None)
+        recoveries.append({'reconnect': reconnect, 'handled': handled})
+    return {
+        'nodes': args.nodes,
+        'tls': bool(args.tls),
+        'duration': round(elapsed, 2),
+        'commands': peer.commands,
+        'statuses': peer.statuses,
+        'lost': peer.commands - len(latencies),
+        'shortPolls': peer.polls,
+        'polled': controller.polled,
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'disconnects': len(drops),
+        'recovery': recoveries,
+        'broker': dict(broker.stats),
+    }
+
+def report(result):
+    OUT.write('{commands} commands, {statuses} statuses, {lost} lost, {throughput} commands/s handled '
+        'over {duration}s\n'.format(**result))
+    OUT.write('command to status p50 {p50_ms}ms p99 {p99_ms}ms, {polled} of {shortPolls} shortPolls handled\n'.format(**result))
+    for i, recovery in enumerate(result['recovery']):
+        OUT.write('disconnect {}: reconnected in {}, handling commands again in {}\n'.format(i + 1,
+            *['{:.3f}s'.format(v) if v is not None else 'never' for v in (recovery['reconnect'], recovery['handled'])]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a NodeServer against a local MQTT broker')
+    parser.add_argument('-n', '--nodes', type=int, default=100)
+    parser.add_argument('-d', '--duration', type=float, default=20)
+    parser.add_argument('--commands', type=float, default=200, help='commands per second')
+    parser.add_argument('--polls', type=float, default=1, help='shortPolls per second')
+    parser.add_argument('--disconnect-every', type=float, default=0, help='seconds between injected disconnects')
+    parser.add_argument('--tls', help='directory with (or for) the TLS certificates')
+    parser.add_argument('-o', '--output', default='loadtest.json')
+    args = parser.parse_args()
+    os.environ.setdefault('PROFILE_NUM', PROFILE)
+    result = run(args)
+    if result is None:
+        sys.exit(1)
+    report(result)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    OUT.write('Saved results to {}\n'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,18 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import netifaces
+import paho.mqtt.client as mqtt
 import polyinterface
+from polyinterface.recorder import RecordedMessage
 
 class TestPoly(unittest.TestCase):
 
@@ -9,5 +22,944 @@ class TestPoly(unittest.TestCase):
         #polyglot.assertIsInstance(polyglot, polyinterface.Interface)
 
 
+def makeInterface(transport):
+    """ A new Interface over transport, whether or not another test made one """
+    exists = polyinterface.Interface._Interface__exists
+    polyinterface.Interface._Interface__exists = False
+    try:
+        return polyinterface.Interface('Test', transport=transport)
+    finally:
+        polyinterface.Interface._Interface__exists = exists
+
+
+class StubPoly(object):
+    def __init__(self):
+        self.sent = []
+        self.config = None
+        self.inQueue = queue.Queue()
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def onConfig(self, callback):
+        pass
+
+    def onStop(self, callback):
+        pass
+
+    def addNotice(self, data):
+        self.send({ 'addnotice': data })
+
+    def removeNotice(self, data):
+        self.send({ 'removenotice': data })
+
+    def addNode(self, node):
+        self.send({ 'addnode': node.address })
+
+
+class StubController(object):
+    def __init__(self):
+        self.poly = StubPoly()
+
+
+class CompactNode(polyinterface.Node):
+    id = 'compact'
+    compact = True
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2}, {'driver': 'GV1', 'value': 0, 'uom': 56}]
+
+
+class TestCompactNode(unittest.TestCase):
+
+    def test_set_driver(self):
+        controller = StubController()
+        node = CompactNode(controller, 'controller', 'n1', 'Node 1')
+        node.updateDrivers([{'driver': 'ST', 'value': '1', 'uom': 2}])
+        node.setDriver('ST', 1)
+        node.setDriver('GV1', 5)
+        self.assertEqual(len(controller.poly.sent), 1)
+        self.assertEqual(controller.poly.sent[0]['status']['driver'], 'GV1')
+        self.assertEqual(dict(node.drivers[1]), {'driver': 'GV1', 'value': 5, 'uom': 56})
+        self.assertIs(CompactNode._driverTemplate(), CompactNode(controller, 'controller', 'n2', 'Node 2')._driverTemplate())
+
+
+class HistoryNode(polyinterface.Node):
+    id = 'history'
+    driverHistorySizes = {'GV1': 4}
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2}, {'driver': 'GV1', 'value': 0, 'uom': 56}]
+
+
+class TestDriverHistory(unittest.TestCase):
+
+    def test_window(self):
+        history = polyinterface.DriverHistory(4)
+        for second, value in enumerate([1, 2, 3, 4, 5, 6]):
+            history.append(value, 100 + second)
+        self.assertEqual(history.values(), [3, 4, 5, 6])
+        self.assertEqual(history.mean(), 4.5)
+        self.assertEqual(history.values(window=1.5, now=105), [5, 6])
+        self.assertEqual((history.min(2, 105), history.max(2, 105)), (4, 6))
+        self.assertEqual(history.rate(), 1.0)
+        self.assertIsNone(history.mean(window=1, now=200))
+
+    def test_set_driver(self):
+        node = HistoryNode(StubController(), 'controller', 'n1', 'Node 1')
+        for value in [1, 'off', 3]:
+            node.setDriver('GV1', value)
+        node.setDriver('ST', 1)
+        self.assertEqual(node.driverHistory('GV1').values(), [1, 3])
+        self.assertIsNone(node.driverHistory('ST'))
+
+
+class SlowLight(polyinterface.Node):
+    id = 'light'
+
+    def __init__(self, *args):
+        super(SlowLight, self).__init__(*args)
+        self.device = []
+        self.busy = threading.Event()
+        self.release = threading.Event()
+
+    def setOn(self, command):
+        self.busy.set()
+        self.release.wait(5)
+        self.device.append(('DON', command['value']))
+
+    def setOff(self, command):
+        self.device.append(('DOF', None))
+
+    commands = {'DON': polyinterface.coalesce(setOn), 'DOF': setOff}
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def test_order_and_replacement(self):
+        node = SlowLight(StubController(), 'controller', 'n1', 'Light')
+        node.runCmd({'cmd': 'DON', 'value': 10})
+        self.assertTrue(node.busy.wait(5))
+        for value in (50, 90):
+            node.runCmd({'cmd': 'DON', 'value': value})
+        node.runCmd({'cmd': 'DOF'})
+        node.release.set()
+        deadline = time.time() + 5
+        while node._commandWorker and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(node.device, [('DON', 10), ('DON', 90), ('DOF', None)])
+        # Nothing waiting, so an unmarked command runs right away on the calling thread
+        node.runCmd({'cmd': 'DOF'})
+        self.assertEqual(node.device[-1], ('DOF', None))
+        self.assertEqual(len(node.device), 4)
+
+
+class TestPollNodes(unittest.TestCase):
+
+    def test_hung_polls_time_out(self):
+        controller = polyinterface.Controller(StubPoly())
+        nodes = [HistoryNode(controller, 'controller', address, address) for address in ('hung1', 'hung2', 'n1')]
+        hang = threading.Event()
+
+        def poll(node):
+            if node.address.startswith('hung'):
+                hang.wait(10)
+            return {'GV1': 1}
+        try:
+            started = time.time()
+            summary = controller.pollNodes(poll, nodes, workers=2, timeout=0.3)
+            self.assertLess(time.time() - started, 2)
+            # n1 never got a worker and was cancelled
+            self.assertEqual(sorted(summary['timedOut']), ['hung1', 'hung2', 'n1'])
+            summary = controller.pollNodes(poll, nodes, workers=2, timeout=0.3)
+            self.assertEqual(sorted(summary['skipped']), ['hung1', 'hung2'])
+        finally:
+            hang.set()
+        deadline = time.time() + 5
+        while controller._pollBusy and time.time() < deadline:
+            time.sleep(0.01)
+        summary = controller.pollNodes(poll, nodes, workers=2, timeout=0.3)
+        self.assertEqual(summary['ok'], 3)
+        self.assertEqual(nodes[2].drivers[1]['value'], 1)
+
+
+def polyglotConfig(value):
+    return {'isyVersion': '5.0.16', 'customParams': {}, 'customData': {}, 'notices': {}, 'customParamsDoc': '',
+        'nodes': [{'address': address, 'name': address, 'node_def_id': 'history', 'primary': 'controller',
+            'isprimary': address == 'controller', 'enabled': True, 'added': True, 'timeAdded': 0,
+            'drivers': [{'driver': 'GV1', 'value': value, 'uom': 56}]} for address in ('controller', 'n1')]}
+
+
+class WarmController(polyinterface.Controller):
+    def __init__(self, poly, snapshotFile):
+        self.snapshotFile = snapshotFile
+        self.startedWith = []
+        self.ready = threading.Event()
+        super(WarmController, self).__init__(poly)
+        self.hub = 'hub'
+
+    def start(self):
+        self.startedWith.append(self.hub)
+        self.addNode(HistoryNode(self, self.address, 'n1', 'Node 1'))
+        self.ready.set()
+
+
+class RacingController(WarmController):
+    """ Polyglot's config arrives on the Events thread while the snapshot is read """
+    def _readSnapshot(self):
+        result = super(RacingController, self)._readSnapshot()
+        events = threading.Thread(target=self._gotConfig, args=(polyglotConfig('2'),), name='Events')
+        events.start()
+        events.join()
+        return result
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def test_config_during_warm_start(self):
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.json')
+        first = WarmController(StubPoly(), path)
+        first._gotConfig(polyglotConfig('1'))
+        self.assertTrue(first.ready.wait(5))
+
+        poly = StubPoly()
+        controller = RacingController(poly, path)
+        controller.warmStart()
+        self.assertTrue(controller.ready.wait(5))
+        self.assertFalse(controller._warm)
+        self.assertEqual(controller.polyConfig['nodes'][1]['drivers'][0]['value'], '2')
+        self.assertEqual(controller._nodes['n1']['drivers'][0]['value'], '2')
+        self.assertEqual([m['addnode'] for m in poly.sent if 'addnode' in m], ['n1'])
+        with open(path) as f:
+            self.assertEqual(json.load(f)['nodes'][1][8], [['GV1', '2', 56]])
+
+    def test_snapshot(self):
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.json')
+        first = WarmController(StubPoly(), path)
+        first._gotConfig(polyglotConfig('1'))
+        self.assertTrue(first.ready.wait(5))
+        with open(path) as f:
+            self.assertEqual([n[0] for n in json.load(f)['nodes']], ['controller', 'n1'])
+
+        poly = StubPoly()
+        second = WarmController(poly, path)
+        self.assertFalse(second.started)
+        second.warmStart()
+        self.assertTrue(second.ready.wait(5))
+        # start ran after the subclass __init__ finished
+        self.assertEqual(second.startedWith, ['hub'])
+        self.assertEqual(poly.config['nodes'][1]['drivers'][0]['value'], '1')
+        self.assertEqual([m for m in poly.sent if 'addnode' in m], [])
+
+        second._gotConfig(polyglotConfig('2'))
+        self.assertEqual([m['addnode'] for m in poly.sent if 'addnode' in m], ['n1'])
+        with open(path) as f:
+            self.assertEqual(json.load(f)['nodes'][1][8], [['GV1', '2', 56]])
+        second.warmStart()
+        self.assertEqual(second.startedWith, ['hub'])
+
+
+class EncodingStubPoly(StubPoly):
+    profileNum = '1'
+    statusTemplate = polyinterface.Interface.statusTemplate
+
+    def sendEncoded(self, payload):
+        self.sent.append(payload)
+
+
+class ThreadStubPoly(StubPoly):
+    """ Keeps the name of the thread each message was sent from """
+    def send(self, message):
+        self.sent.append((threading.current_thread().name, message))
+
+
+class RecordingPool(object):
+    def __init__(self):
+        self.requests = []
+
+    def send(self, address, request):
+        self.requests.append(request)
+
+
+class TestReportAllDrivers(unittest.TestCase):
+
+    def setUp(self):
+        self.poly = ThreadStubPoly()
+        self.controller = polyinterface.Controller(self.poly)
+        self.controller.statusChunkSize = 1
+        self.chunks = []
+        put = self.controller._statusQueue.put
+        self.controller._statusQueue.put = lambda chunk: (self.chunks.append(len(chunk)), put(chunk))
+        self.light = ReplayLight(self.controller, 'controller', 'light1', 'Light')
+        self.compact = CompactNode(self.controller, 'controller', 'n1', 'Node 1')
+        self.pool = RecordingPool()
+        sharded = polyinterface.sharding.ShardedNode(self.controller, self.pool, ReplayLight, 'controller', 'shard1', 'Shard')
+        for node in (self.light, self.compact, sharded):
+            self.controller.nodes[node.address] = node
+
+    def reported(self, request):
+        del self.poly.sent[:]
+        self.poly.inQueue.put(request)
+        self.poly.inQueue.join()
+        self.controller._statusQueue.join()
+        return [(thread, m['status']['address'], m['status']['driver'], m['status']['value'])
+            for thread, m in self.poly.sent if m['status']['address'] != 'controller']
+
+    def test_status_and_query_all(self):
+        self.light.setDriver('ST', 100, report=False)
+        self.compact.setDriver('GV1', 5, report=False)
+        self.assertEqual(sorted(self.reported({'status': {'address': 'all'}})),
+            [('Status', 'light1', 'ST', '100'), ('Status', 'n1', 'GV1', '5')])
+        self.assertEqual(set(self.chunks), {1})
+        self.assertEqual((self.light._drivers[0]['value'], self.compact._driverRecord('GV1').reported), (100, 5))
+        # Reported drivers are unchanged now
+        self.assertEqual(self.reported({'status': {'address': 'all'}}), [])
+        self.assertEqual(sorted(self.reported({'query': {'address': 'all'}})),
+            [('Status', 'light1', 'ST', '100'), ('Status', 'n1', 'GV1', '5'), ('Status', 'n1', 'ST', '0')])
+        self.assertEqual(self.pool.requests, [('reportDrivers', 'shard1')] * 3)
+
+
+class TestStatusTemplates(unittest.TestCase):
+
+    def test_same_json_as_send(self):
+        controller = StubController()
+        controller.poly = EncodingStubPoly()
+        for cls in (HistoryNode, CompactNode):
+            node = cls(controller, 'controller', 'n1', 'Node "1"')
+            node._buildStatusTemplates()
+            node.setDriver('GV1', 'on\u00e9', uom=25)
+            message = {'status': {'address': 'n1', 'driver': 'GV1', 'value': 'on\u00e9', 'uom': 25}, 'node': '1'}
+            self.assertEqual(controller.poly.sent.pop(), json.dumps(message))
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_stages(self):
+        tracer = polyinterface.Tracer()
+        message = {'command': {'address': 'n1', 'cmd': 'DON'}}
+        tracer.received(message)
+        tracer.published(time.time())
+        tracer.dispatched(message)
+        tracer.published(time.time())
+        tracer.finished(message)
+        trace = tracer.traces[0]
+        self.assertEqual((trace.key, trace.address, trace.cmd, trace.publishes), ('command', 'n1', 'DON', 1))
+        self.assertTrue(trace.received <= trace.dispatched <= trace.firstPublish <= trace.finished)
+        summary = tracer.summary('command')
+        self.assertEqual(summary['status']['count'], 1)
+        self.assertEqual(tracer.summary('shortPoll')['total']['count'], 0)
+
+
+class TestNodeRegistry(unittest.TestCase):
+
+    def test_iterate_while_writing(self):
+        nodes = polyinterface.NodeRegistry(('n{}'.format(i), i) for i in range(5000))
+        done = threading.Event()
+
+        def writer():
+            i = 5000
+            while not done.is_set():
+                nodes['n{}'.format(i)] = i
+                nodes.pop('n{}'.format(i - 5000), None)
+                i += 1
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            for _ in range(50):
+                self.assertIn(len([address for address in nodes]), (5000, 5001))
+                self.assertIn(len([node for node in nodes.values()]), (5000, 5001))
+        finally:
+            done.set()
+            thread.join()
+
+    def test_pending_nodes(self):
+        adding = polyinterface.PendingNodes(['a', 'b'])
+        adding.append('a')
+        self.assertEqual(adding, ['a', 'b', 'a'])
+        self.assertEqual(adding[1], 'b')
+        adding.remove('a')
+        self.assertIn('a', adding)
+        self.assertEqual(list(adding), ['b', 'a'])
+        adding.extend(['c', 'b'])
+        adding.remove('b')
+        self.assertEqual(adding, ['a', 'c', 'b'])
+        adding.remove('a')
+        self.assertNotIn('a', adding)
+        self.assertRaises(ValueError, adding.remove, 'a')
+        self.assertEqual((len(adding), adding[0]), (2, 'c'))
+        # Like list.remove, only the earliest of duplicates goes
+        many = polyinterface.PendingNodes(['x', 'y'] * 50)
+        for _ in range(40):
+            many.remove('y')
+        self.assertEqual(list(many), ['x'] * 40 + ['x', 'y'] * 10)
+        for _ in range(45):
+            many.remove('x')
+        self.assertEqual(list(many), ['y'] * 5 + ['x', 'y'] * 5)
+        self.assertLessEqual(len(many._order), 2 * len(many) + 16)
+
+
+class TestProfileHost(unittest.TestCase):
+
+    def test_routing(self):
+        host = polyinterface.ProfileHost(polyinterface.MemoryTransport(polyinterface.MemoryBroker()))
+        first, second = host.addProfile(3), host.addProfile(4)
+        self.assertRaises(ValueError, host.addProfile, '3')
+        payload = json.dumps({'node': 'polyglot', 'command': {'address': 'n1', 'cmd': 'DON'}}).encode('utf-8')
+        host._message(None, None, RecordedMessage('udi/polyglot/ns/4', payload))
+        self.assertTrue(first.inQueue.empty())
+        self.assertEqual(second.inQueue.get_nowait()['command']['address'], 'n1')
+        self.assertEqual(second.topicInput, 'udi/polyglot/ns/4')
+
+
+    def test_record_hosted_profiles(self):
+        folder = tempfile.mkdtemp()
+        os.environ['POLY_RECORD'] = os.path.join(folder, 'traffic.jsonl.gz')
+        os.environ['POLY_TRACE'] = os.path.join(folder, 'trace.jsonl')
+        try:
+            host = polyinterface.ProfileHost(polyinterface.MemoryTransport(polyinterface.MemoryBroker()))
+            profiles = [host.addProfile(3), host.addProfile(4)]
+            for poly in profiles:
+                poly.start()
+        finally:
+            del os.environ['POLY_RECORD'], os.environ['POLY_TRACE']
+        for profile in ('3', '4'):
+            payload = json.dumps({'node': 'polyglot', 'command': {'address': 'n' + profile, 'cmd': 'DON'}})
+            host._message(None, None, RecordedMessage('udi/polyglot/ns/' + profile, payload.encode('utf-8')))
+        self.assertEqual([poly.inQueue.get_nowait()['command']['address'] for poly in profiles], ['n3', 'n4'])
+        for poly in profiles:
+            poly.stop()
+        self.assertEqual(host.transport.on_message, host._message)
+        self.assertEqual(sorted(os.listdir(folder)),
+            ['trace-3.jsonl', 'trace-4.jsonl', 'traffic-3.jsonl.gz', 'traffic-4.jsonl.gz'])
+        for profile in ('3', '4'):
+            replayer = polyinterface.Replayer(profiles[0], os.path.join(folder, 'traffic-{}.jsonl.gz'.format(profile)))
+            self.assertEqual([r[2] for r in replayer.records if r[1] == 'in'], ['udi/polyglot/ns/' + profile])
+
+
+class ShardLight(polyinterface.Node):
+    id = 'light'
+    drivers = [
+        {'driver': 'ST', 'value': 0, 'uom': 51},
+        {'driver': 'GV1', 'value': 0, 'uom': 56},
+    ]
+
+    def shortPoll(self):
+        self.setDriver('GV1', 1)
+
+    def cmd_don(self, command):
+        self.setDriver('ST', 100)
+
+    commands = {'DON': cmd_don}
+
+
+class HangingLight(ShardLight):
+    def stop(self):
+        time.sleep(30)
+
+
+class QueuePoly(object):
+    def __init__(self):
+        self.sent = queue.Queue()
+        self.shutdownDeadline = None
+
+    def send(self, message):
+        self.sent.put(message)
+
+
+class TestSharding(unittest.TestCase):
+
+    def test_forwarding(self):
+        poly = QueuePoly()
+        pool = polyinterface.sharding.ShardPool(poly, 2).start()
+        try:
+            pool.add(ShardLight, 'controller', 'light1', 'Light', (), {})
+            pool.send('light1', ('command', 'light1', {'address': 'light1', 'cmd': 'DON'}))
+            self.assertEqual(poly.sent.get(timeout=30)['status'],
+                {'address': 'light1', 'driver': 'ST', 'value': '100', 'uom': 51})
+            pool.broadcast(('shortPoll',))
+            self.assertEqual(poly.sent.get(timeout=10)['status']['driver'], 'GV1')
+            pool.send('light1', ('status', 'light1'))
+            reported = [poly.sent.get(timeout=10)['status'] for _ in range(2)]
+            self.assertEqual([(s['driver'], s['value']) for s in reported], [('ST', 100), ('GV1', 1)])
+        finally:
+            pool.stop()
+        self.assertTrue(poly.sent.empty())
+
+    def test_stop_within_deadline(self):
+        poly = QueuePoly()
+        pool = polyinterface.sharding.ShardPool(poly, 2).start()
+        addresses = dict((pool.shardFor('light{}'.format(i)), 'light{}'.format(i)) for i in range(10))
+        self.assertEqual(len(addresses), 2)
+        for address in addresses.values():
+            pool.add(HangingLight, 'controller', address, 'Light', (), {})
+        # Both shards hang in stop, together they get what is left of the shutdown budget
+        poly.shutdownDeadline = time.time() + 1
+        started = time.time()
+        pool.stop()
+        self.assertLess(time.time() - started, 2)
+
+
+def waitUntil(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out waiting')
+        time.sleep(0.01)
+
+
+class ReplayLight(polyinterface.Node):
+    id = 'light'
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 51}]
+    level = 100
+
+    def cmd_don(self, command):
+        self.setDriver('ST', self.level)
+
+    commands = {'DON': cmd_don}
+
+
+class DimLight(ReplayLight):
+    level = 50
+
+
+class ReplayController(polyinterface.Controller):
+    def __init__(self, poly, lightClass):
+        self.lightClass = lightClass
+        super(ReplayController, self).__init__(poly)
+
+    def start(self):
+        self.addNode(self.lightClass(self, self.address, 'light1', 'Light'))
+
+
+class TestRecordReplay(unittest.TestCase):
+
+    def replay(self, path, lightClass):
+        poly = makeInterface(polyinterface.MemoryTransport(polyinterface.MemoryBroker()))
+        ReplayController(poly, lightClass)
+        poly.start()
+        try:
+            return polyinterface.Replayer(poly, path).run(settle=0.3)
+        finally:
+            poly.stop(budget=1)
+
+    def test_round_trip(self):
+        path = os.path.join(tempfile.mkdtemp(), 'traffic.jsonl.gz')
+        broker = polyinterface.MemoryBroker()
+        poly = makeInterface(polyinterface.MemoryTransport(broker))
+        controller = ReplayController(poly, ReplayLight)
+        recorder = polyinterface.Recorder(poly, path).start()
+        poly.start()
+        polyglot = polyinterface.MemoryTransport(broker)
+        try:
+            waitUntil(lambda: broker._subscriptions.get(poly.topicInput))
+            polyglot.publish(poly.topicInput, json.dumps({'node': 'polyglot', 'config': polyglotConfig('1')}))
+            waitUntil(lambda: 'light1' in controller.nodes)
+            polyglot.publish(poly.topicInput, json.dumps({'node': 'polyglot',
+                'command': {'address': 'light1', 'cmd': 'DON'}}))
+            waitUntil(lambda: controller.nodes['light1'].drivers[0]['value'] == 100)
+            time.sleep(0.1)
+        finally:
+            recorder.stop()
+            poly.stop(budget=1)
+
+        records = polyinterface.Replayer(poly, path).records
+        # The Interface's own messages come back on its topic too, and are ignored
+        fromPolyglot = [json.loads(r[3]) for r in records if r[1] == 'in' and json.loads(r[3])['node'] == 'polyglot']
+        self.assertEqual([sorted(m) for m in fromPolyglot], [['config', 'node'], ['command', 'node']])
+        self.assertTrue(any('addnode' in json.loads(r[3]) for r in records if r[1] == 'out'))
+
+        report = self.replay(path, ReplayLight)
+        self.assertEqual((report['missing'], report['unexpected']), ([], []))
+
+        report = self.replay(path, DimLight)
+        self.assertEqual([json.loads(m)['status']['value'] for m in report['missing']], ['100'])
+        self.assertEqual([json.loads(m)['status']['value'] for m in report['unexpected']], ['50'])
+
+
+class TestMqttBroker(unittest.TestCase):
+
+    def test_publish_and_drop(self):
+        broker = polyinterface.MqttBroker().start()
+        received = queue.Queue()
+        dropped = threading.Event()
+        client = mqtt.Client('test')
+        client.on_message = lambda c, u, msg: received.put((msg.topic, msg.payload, msg.retain))
+        client.on_disconnect = lambda c, u, rc: dropped.set()
+        try:
+            client.connect('127.0.0.1', broker.port)
+            client.loop_start()
+            client.publish('udi/test/retained', b'kept', qos=1, retain=True).wait_for_publish()
+            client.subscribe('udi/test/#')
+            self.assertEqual(received.get(timeout=5), ('udi/test/retained', b'kept', 1))
+            client.publish('udi/test/live', b'x' * 300)
+            self.assertEqual(received.get(timeout=5), ('udi/test/live', b'x' * 300, 0))
+            self.assertEqual(broker.dropClients(), 1)
+            self.assertTrue(dropped.wait(5))
+        finally:
+            client.loop_stop()
+            broker.stop()
+
+
+class TestTransports(unittest.TestCase):
+
+    def test_transport_is_abstract(self):
+        class Partial(polyinterface.transport.Transport):
+            def _connect(self):
+                pass
+        self.assertRaises(TypeError, Partial)
+
+    def test_memory_round_trip(self):
+        broker = polyinterface.MemoryBroker()
+        broker.publish('udi/test/retained', b'kept', retain=True)
+        received = queue.Queue()
+        client = polyinterface.MemoryTransport(broker)
+        client.on_message = lambda c, u, msg: received.put((msg.topic, msg.payload, msg.retain))
+        client.on_connect = lambda c, u, flags, rc: c.subscribe('udi/test/#')
+        thread = threading.Thread(target=client.loop_forever)
+        thread.start()
+        try:
+            self.assertEqual(received.get(timeout=5), ('udi/test/retained', b'kept', True))
+            polyinterface.MemoryTransport(broker).publish('udi/test/live', '{"x": 1}')
+            self.assertEqual(received.get(timeout=5), ('udi/test/live', b'{"x": 1}', False))
+        finally:
+            client.disconnect()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_unix_socket_round_trip(self):
+        path = os.path.join(tempfile.mkdtemp(), 'mqtt.sock')
+        broker = polyinterface.UnixSocketBroker(path).start()
+        received = queue.Queue()
+        connected = threading.Event()
+        subscribed = threading.Event()
+        client = polyinterface.UnixSocketTransport(path, 'test')
+        client.on_message = lambda c, u, msg: received.put((msg.topic, msg.payload, msg.retain))
+        client.on_connect = lambda c, u, flags, rc: connected.set()
+        client.on_subscribe = lambda c, u, mid, qos: subscribed.set()
+        try:
+            client.connect_async('localhost', 1883)
+            client.loop_start()
+            self.assertTrue(connected.wait(5))
+            client.publish('udi/test/retained', b'kept', qos=1, retain=True).wait_for_publish()
+            client.subscribe('udi/test/#')
+            self.assertTrue(subscribed.wait(5))
+            self.assertEqual(received.get(timeout=5), ('udi/test/retained', b'kept', 1))
+            client.publish('udi/test/live', b'x' * 300)
+            self.assertEqual(received.get(timeout=5), ('udi/test/live', b'x' * 300, 0))
+            self.assertEqual(broker.stats['connects'], 1)
+        finally:
+            client.disconnect()
+            client.loop_stop()
+            broker.stop()
+        self.assertFalse(os.path.exists(path))
+
+
+class DisconnectedTransport(polyinterface.MemoryTransport):
+    """ Publishes fail the way paho's do while the connection is down """
+    def __init__(self):
+        polyinterface.MemoryTransport.__init__(self, polyinterface.MemoryBroker())
+        self.disconnects = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = mqtt.MQTTMessageInfo(self._nextMid())
+        info.rc = mqtt.MQTT_ERR_NO_CONN
+        return info
+
+    def disconnect(self):
+        self.disconnects += 1
+
+
+class TestShutdown(unittest.TestCase):
+
+    def test_stop_after_failed_publish(self):
+        transport = DisconnectedTransport()
+        poly = makeInterface(transport)
+        stops = []
+        # Stopping again from inside the stop, like a delete handled while draining
+        poly.onStop(lambda: stops.append(poly.stop()))
+        poly.connected = True
+        poly.send({'status': {'address': 'n1', 'driver': 'ST', 'value': '1', 'uom': 2}})
+        self.assertRaises(RuntimeError, poly._lastPublish.is_published)
+        started = time.time()
+        poly.stop(budget=2)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(transport.disconnects, 1)
+        self.assertEqual(len(stops), 1)
+
+
+class SaveTransport(polyinterface.MemoryTransport):
+    """ Keeps the customdata and customparams saves published """
+    def __init__(self):
+        polyinterface.MemoryTransport.__init__(self, polyinterface.MemoryBroker())
+        self.saves = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        message = json.loads(payload)
+        for key in ('customdata', 'customparams'):
+            if key in message:
+                self.saves.append((key, message[key]))
+        return polyinterface.MemoryTransport.publish(self, topic, payload, qos, retain)
+
+
+class TestSaves(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = SaveTransport()
+        self.poly = makeInterface(self.transport)
+        self.poly.SAVE_DEBOUNCE = 0.1
+        self.poly.SAVE_MAX_DELAY = 0.3
+
+    def test_burst_published_once(self):
+        for i in range(5):
+            self.poly.saveCustomData({'count': i})
+        self.assertEqual(self.transport.saves, [])
+        time.sleep(0.3)
+        self.assertEqual(self.transport.saves, [('customdata', {'count': 4})])
+
+    def test_unchanged_skipped(self):
+        self.poly.inConfig({'isyVersion': '5.0.16', 'customData': {'count': 1}, 'customParams': {'host': 'a'}})
+        self.poly.saveCustomData({'count': 1})
+        self.poly.saveCustomParams({'host': 'b'})
+        self.poly.flushSaves()
+        self.assertEqual(self.transport.saves, [('customparams', {'host': 'b'})])
+        self.poly.saveCustomParams({'host': 'b'})
+        self.poly.flushSaves()
+        self.assertEqual(len(self.transport.saves), 1)
+
+    def test_max_delay(self):
+        # Saves every 50ms never leave SAVE_DEBOUNCE quiet, SAVE_MAX_DELAY publishes anyway
+        start = time.time()
+        count = 0
+        while time.time() - start < 0.6:
+            self.poly.saveCustomData({'count': count})
+            count += 1
+            time.sleep(0.05)
+        during = len(self.transport.saves)
+        self.assertTrue(1 <= during <= 3, during)
+        time.sleep(0.3)
+        self.assertEqual(self.transport.saves[-1], ('customdata', {'count': count - 1}))
+
+    def test_flushed_on_stop(self):
+        self.poly.SAVE_DEBOUNCE = self.poly.SAVE_MAX_DELAY = 60
+        self.poly.saveCustomParams({'host': 'a'})
+        self.assertEqual(self.transport.saves, [])
+        self.poly.stop(budget=1)
+        self.assertEqual(self.transport.saves, [('customparams', {'host': 'a'})])
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.closed = []
+        self.pool = polyinterface.ConnectionPool(maxPerKey=2, maxTotal=3, idleTimeout=60)
+        for key in ('a', 'b', 'c'):
+            self.register(key)
+
+    def register(self, key):
+        created = iter(range(100))
+        self.pool.register(key, lambda: '{}{}'.format(key, next(created)), self.closed.append)
+
+    def test_limits(self):
+        self.assertEqual([self.pool.acquire('a'), self.pool.acquire('a')], ['a0', 'a1'])
+        self.assertRaises(polyinterface.PoolTimeout, self.pool.acquire, 'a', 0.05)
+        self.assertEqual(self.pool.acquire('b'), 'b0')
+        self.assertRaises(polyinterface.PoolTimeout, self.pool.acquire, 'c', 0.05)
+        stats = self.pool.stats()
+        self.assertEqual((stats['a']['open'], stats['b']['open'], stats['c']['open']), (2, 1, 0))
+        self.assertTrue(stats['a']['waits'] and stats['c']['waits'])
+        self.pool.release('a', 'a1')
+        self.assertEqual(self.pool.acquire('a'), 'a1')
+        self.assertEqual(self.pool.stats()['a']['reused'], 1)
+
+    def test_eviction(self):
+        held = [('a', self.pool.acquire('a')), ('a', self.pool.acquire('a')), ('b', self.pool.acquire('b'))]
+        for key, conn in [held[2], held[0], held[1]]:
+            self.pool.release(key, conn)
+            time.sleep(0.01)
+        self.assertEqual(self.pool.acquire('c'), 'c0')
+        # The oldest idle connection made room for c
+        self.assertEqual(self.closed, ['b0'])
+        self.pool.release('c', 'c0')
+        self.pool.idleTimeout = 0
+        time.sleep(0.01)
+        self.pool.evictIdle()
+        self.assertEqual(sorted(self.closed), ['a0', 'a1', 'b0', 'c0'])
+        self.assertEqual(sum(s['open'] for s in self.pool.stats().values()), 0)
+
+    def test_wait_for_release(self):
+        held = [self.pool.acquire('a'), self.pool.acquire('a')]
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.pool.acquire('a', timeout=5)))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(got, [])
+        self.pool.release('a', held[0])
+        waiter.join(5)
+        self.assertEqual(got, ['a0'])
+
+    def test_discard_and_close(self):
+        with self.assertRaises(ValueError):
+            with self.pool.connection('a') as conn:
+                raise ValueError(conn)
+        self.assertEqual(self.closed, ['a0'])
+        with self.pool.connection('a') as conn:
+            self.pool.close()
+        self.assertEqual(self.closed, ['a0', 'a1'])
+        self.assertRaises(polyinterface.PoolTimeout, self.pool.acquire, 'a')
+
+    def test_delete_uses_connections(self):
+        poly = makeInterface(polyinterface.MemoryTransport(polyinterface.MemoryBroker()))
+        controller = DeletingController(poly)
+        controller.connections.register('hub', lambda: 'hub0', self.closed.append)
+        controller._delete()
+        self.assertEqual(controller.farewell, 'hub0')
+        self.assertEqual(self.closed, ['hub0'])
+
+
+class DeletingController(polyinterface.Controller):
+    def delete(self):
+        with self.connections.connection('hub', timeout=1) as conn:
+            self.farewell = conn
+
+
+class TestEvents(unittest.TestCase):
+
+    def test_slow_config_observer(self):
+        poly = makeInterface(polyinterface.MemoryTransport(polyinterface.MemoryBroker()))
+        seen = []
+
+        def observer(config):
+            time.sleep(0.2)
+            seen.append((threading.current_thread().name, config['isyVersion'], poly.polyglotConnected))
+        poly.onConfig(observer)
+        poly._threads['events'].start()
+        started = time.time()
+        for message in ({'config': dict(polyglotConfig('1'), isyVersion='1')},
+                {'config': dict(polyglotConfig('1'), isyVersion='2')}, {'connected': True}):
+            message['node'] = 'polyglot'
+            poly._message(None, None, RecordedMessage(poly.topicInput, json.dumps(message).encode('utf-8')))
+        self.assertLess(time.time() - started, 0.1)
+        poly.eventQueue.join()
+        self.assertEqual([s[:2] for s in seen], [('Events', '1'), ('Events', '2')])
+        self.assertNotEqual(seen[1][2], True)
+        self.assertTrue(poly.polyglotConnected)
+        stats = poly.threadStats()
+        self.assertEqual((stats['MQTT']['count'], stats['Events']['count']), (3, 3))
+        self.assertLess(stats['MQTT']['busy'], 0.1)
+        self.assertGreaterEqual(stats['Events']['busy'], 0.4)
+        self.assertGreaterEqual(stats['Events']['max'], 0.2)
+
+
+class FakeNetifaces(object):
+    """ Replaces the netifaces functions NetworkInfo reads """
+    def __init__(self):
+        self.reads = 0
+        self.gateway = ('192.168.1.1', 'eth0')
+        self.addresses = {
+            'eth0': {netifaces.AF_INET: [{'addr': '192.168.1.10', 'netmask': '255.255.255.0', 'broadcast': '192.168.1.255'}],
+                netifaces.AF_INET6: [{'addr': 'fe80::1%eth0', 'netmask': 'ffff:ffff:ffff:ffff::/64'}]},
+            'wlan0': {netifaces.AF_INET: [{'addr': '10.0.0.5', 'netmask': '255.0.0.0', 'broadcast': '10.255.255.255'}]},
+        }
+        self.saved = dict((name, getattr(netifaces, name)) for name in ('gateways', 'interfaces', 'ifaddresses'))
+        netifaces.gateways = self.gateways
+        netifaces.interfaces = lambda: list(self.addresses)
+        netifaces.ifaddresses = lambda name: self.addresses[name]
+
+    def gateways(self):
+        self.reads += 1
+        return {'default': {netifaces.AF_INET: self.gateway}}
+
+    def restore(self):
+        for name, fun in self.saved.items():
+            setattr(netifaces, name, fun)
+
+
+class TestNetworkInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeNetifaces()
+        self.info = polyinterface.NetworkInfo(ttl=60)
+
+    def tearDown(self):
+        self.fake.restore()
+
+    def test_cached(self):
+        self.assertEqual(self.info.get()['addr'], '192.168.1.10')
+        self.fake.gateway = ('10.0.0.1', 'wlan0')
+        self.assertEqual(self.info.get()['addr'], '192.168.1.10')
+        self.assertEqual(self.fake.reads, 1)
+        self.info.ttl = 0
+        self.assertEqual(self.info.get()['addr'], '10.0.0.5')
+        self.assertEqual(self.info.gateway(), '10.0.0.1')
+
+    def test_lookup(self):
+        self.assertEqual(self.info.get('wlan0')['addr'], '10.0.0.5')
+        self.assertEqual(self.info.get('eth0', netifaces.AF_INET6)['addr'], 'fe80::1%eth0')
+        self.assertEqual(self.info.addresses('wlan0', netifaces.AF_INET6), [])
+        self.assertEqual(self.info.get('missing')['addr'], False)
+        self.assertEqual(sorted(self.info.interfaces()), ['eth0', 'wlan0'])
+
+    def test_results_are_copies(self):
+        self.info.get()['addr'] = 'changed'
+        self.info.addresses()[0]['netmask'] = 'changed'
+        self.assertEqual(self.info.get(), self.fake.addresses['eth0'][netifaces.AF_INET][0])
+        self.assertFalse(self.info.refresh(force=True))
+
+    def test_subscribe(self):
+        changes = []
+        self.info.interval = 60
+        self.info.subscribe(lambda old, new: changes.append((old['default'], new['default'])))
+        try:
+            self.assertFalse(self.info.refresh(force=True))
+            self.fake.gateway = ('10.0.0.1', 'wlan0')
+            self.assertFalse(self.info.refresh())
+            self.assertTrue(self.info.refresh(force=True))
+            self.assertEqual(changes, [({netifaces.AF_INET: ('192.168.1.1', 'eth0')},
+                {netifaces.AF_INET: ('10.0.0.1', 'wlan0')})])
+        finally:
+            self.info.stop()
+
+
+class TestNotices(unittest.TestCase):
+
+    def test_set_notices(self):
+        poly = StubPoly()
+        poly.config = { 'notices': { 'a': 'keep', 'b': 'old', 'c': 'gone' } }
+        controller = polyinterface.Controller(poly)
+        controller.setNotices({ 'a': 'keep', 'b': 'new', 'd': 'added' })
+        self.assertEqual(sorted(list(m.keys())[0] + ':' + list(m.values())[0]['key'] for m in poly.sent),
+            ['addnotice:b', 'addnotice:d', 'removenotice:c'])
+        del poly.sent[:]
+        controller.removeNoticesAll()
+        controller.removeNoticesAll()
+        self.assertEqual(len(poly.sent), 3)
+
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def test_sweep_loopback(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.1', 0))
+        openPort, closedPort = listener.getsockname()[1], closed.getsockname()[1]
+        closed.close()
+        discovery = polyinterface.Discovery(timeout=0.5)
+        found = discovery.discover(hosts=['127.0.0.1'], ports=[openPort, closedPort])
+        self.assertEqual([(f['host'], f['port']) for f in found], [('127.0.0.1', openPort)])
+        listener.close()
+        # Served from the cache the second time
+        self.assertEqual(len(discovery.discover(hosts=['127.0.0.1'], ports=[openPort, closedPort])), 1)
+
+    def test_ssdp_loopback(self):
+        responder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        responder.bind(('127.0.0.1', 0))
+        def respond():
+            data, addr = responder.recvfrom(1024)
+            responder.sendto(b'HTTP/1.1 200 OK\r\nST: upnp:rootdevice\r\nLOCATION: http://127.0.0.1/desc.xml\r\n\r\n', addr)
+        threading.Thread(target=respond).start()
+        found = polyinterface.Discovery().discoverSsdp(mx=0, address=responder.getsockname())
+        responder.close()
+        self.assertEqual(found[0]['location'], 'http://127.0.0.1/desc.xml')
+
+
 if __name__ == "__main__":
     unittest.main()
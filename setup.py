@@ -17,7 +17,8 @@ setup(name='polyinterface',
         "paho-mqtt",
         "python-dotenv",
         "markdown2",
-        "netifaces"
+        "netifaces",
+        "futures; python_version < '3'"
     ],
     python_requires='>2.7,!=3.0.*,!=3.1.*,!=3.2.*',
     zip_safe=False,